@@ -0,0 +1,133 @@
+import bisect
+import time
+from contextlib import contextmanager
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.values = dict()
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.values.get(_label_key(labels), 0)
+
+    def render(self):
+        return ['%s%s %s' % (self.name, _format_labels(key), _format_value(value))
+                for key, value in sorted(self.values.items())]
+
+
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name, description, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(sorted(buckets))
+        self.values = dict()
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        if key not in self.values:
+            self.values[key] = dict(counts=[0] * len(self.buckets), sum=0.0, count=0)
+        series = self.values[key]
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series['counts'][index] += 1
+        series['sum'] += value
+        series['count'] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def get(self, **labels):
+        return self.values.get(_label_key(labels), dict(counts=[0] * len(self.buckets), sum=0.0, count=0))
+
+    def render(self):
+        lines = []
+        for key, series in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, series['counts']):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (self.name, _format_labels(key + (('le', _format_value(bound)),)),
+                                                 cumulative))
+            lines.append('%s_bucket%s %d' % (self.name, _format_labels(key + (('le', '+Inf'),)), series['count']))
+            lines.append('%s_sum%s %s' % (self.name, _format_labels(key), _format_value(series['sum'])))
+            lines.append('%s_count%s %d' % (self.name, _format_labels(key), series['count']))
+        return lines
+
+
+class MetricsRegistry:
+    """In-process registry of emu counters and histograms, rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self.metrics = dict()
+
+    def counter(self, name, description):
+        return self._register(name, lambda: Counter(name, description))
+
+    def histogram(self, name, description, buckets=DEFAULT_BUCKETS):
+        return self._register(name, lambda: Histogram(name, description, buckets))
+
+    def render(self):
+        lines = []
+        for name, metric in sorted(self.metrics.items()):
+            lines.append('# HELP %s %s' % (name, metric.description))
+            lines.append('# TYPE %s %s' % (name, metric.type))
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def _register(self, name, factory):
+        if name not in self.metrics:
+            self.metrics[name] = factory()
+        return self.metrics[name]
+
+
+def _label_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _format_labels(key):
+    if not key:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"') for _, value in key)
+    return '{%s}' % ','.join('%s="%s"' % (name, value) for (name, _), value in zip(key, escaped))
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+metrics = MetricsRegistry()
+
+beacons_total = metrics.counter('emu_beacons_total', 'Forwarded beacons received, by endpoint and result.')
+beacon_request_seconds = metrics.histogram('emu_beacon_request_seconds',
+                                           'Time spent handling forwarded beacon requests, by endpoint.')
+beacon_heartbeat_seconds = metrics.histogram('emu_beacon_heartbeat_seconds',
+                                             'Time spent in contact_svc.handle_heartbeat for forwarded beacons.')
+beacons_coalesced_total = metrics.counter('emu_beacons_coalesced_total',
+                                          'Forwarded beacons answered from the coalescing cache.')
+ingestion_phase_seconds = metrics.histogram('emu_ingestion_phase_seconds', 'Time spent in each ingestion phase.')
+planner_links_generated_total = metrics.counter('emu_planner_links_generated_total',
+                                                'Links generated by the group filtered planner.')
+planner_links_discarded_total = metrics.counter('emu_planner_links_discarded_total',
+                                                'Generated links discarded by the group filtered planner.')
+planner_abilities_skipped_total = metrics.counter('emu_planner_abilities_skipped_total',
+                                                  'Abilities skipped by the group filtered planner because no agent '
+                                                  'can run them.')
+planner_bucket_seconds = metrics.histogram('emu_planner_bucket_seconds',
+                                           'Time spent in each group filtered planner bucket.')
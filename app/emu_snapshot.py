@@ -0,0 +1,103 @@
+"""
+Build a precompiled snapshot of the data and payloads generated by emu ingestion, so that Caldera
+servers can install it at startup instead of cloning, decrypting and ingesting the library themselves.
+
+Run from the Caldera root directory:
+
+    python -m plugins.emu.app.emu_snapshot --output emu-snapshot.tar.gz
+
+Then set `snapshot_path` in plugins/emu/conf/default.yml to the generated archive on each server.
+"""
+import argparse
+import asyncio
+import hashlib
+import io
+import json
+import logging
+import os
+import subprocess
+import tarfile
+import tempfile
+import time
+
+SNAPSHOT_FORMAT_VERSION = 1
+SNAPSHOT_METADATA = 'snapshot.json'
+SNAPSHOT_DATA_DIRS = ('abilities', 'adversaries', 'sources', 'planners')
+
+
+def checksum_path(snapshot_path):
+    return '%s.sha256' % snapshot_path
+
+
+def compute_checksum(path, chunk_size=1024 * 1024):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def read_checksum(snapshot_path):
+    with open(checksum_path(snapshot_path), 'r') as f:
+        return f.read().split()[0]
+
+
+def get_library_revision(repo_dir):
+    try:
+        return subprocess.check_output(['git', '-C', repo_dir, 'rev-parse', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def build_snapshot(emu_svc, output_path, clone=True):
+    """
+    Run the emu ingestion pipeline into a staging directory and package the generated data and payloads
+    as a versioned snapshot archive, with its sha256 checksum written next to it.
+    """
+    with tempfile.TemporaryDirectory() as staging_dir:
+        emu_svc.data_dir = os.path.join(staging_dir, 'data')
+        emu_svc.payloads_dir = os.path.join(staging_dir, 'payloads')
+        emu_svc.manifest_path = os.path.join(staging_dir, 'ingestion_manifest.json')
+        os.makedirs(emu_svc.payloads_dir)
+        if clone:
+            await emu_svc.clone_repo()
+        await emu_svc.decrypt_payloads()
+        await emu_svc.populate_data_directory()
+
+        metadata = dict(format_version=SNAPSHOT_FORMAT_VERSION,
+                        library_revision=get_library_revision(emu_svc.repo_dir),
+                        created=time.time())
+        with tarfile.open(output_path, 'w:gz') as snapshot:
+            encoded = json.dumps(metadata, indent=2).encode()
+            info = tarfile.TarInfo(SNAPSHOT_METADATA)
+            info.size = len(encoded)
+            snapshot.addfile(info, io.BytesIO(encoded))
+            for data_dir in SNAPSHOT_DATA_DIRS:
+                source_dir = os.path.join(emu_svc.data_dir, data_dir)
+                if os.path.isdir(source_dir):
+                    snapshot.add(source_dir, arcname='data/%s' % data_dir)
+            snapshot.add(emu_svc.payloads_dir, arcname='payloads')
+    with open(checksum_path(output_path), 'w') as f:
+        f.write('%s  %s\n' % (compute_checksum(output_path), os.path.basename(output_path)))
+    return metadata
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build a precompiled emu ingestion snapshot.')
+    parser.add_argument('--output', required=True, help='path of the snapshot archive to create')
+    parser.add_argument('--repo-url', help='Adversary Emulation Library url, bare mirror or tarball to ingest')
+    parser.add_argument('--no-clone', action='store_true', help='ingest the existing library checkout as is')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    from plugins.emu.app.emu_svc import EmuService
+    emu_svc = EmuService()
+    if args.repo_url:
+        emu_svc.repo_url = args.repo_url
+    metadata = asyncio.run(build_snapshot(emu_svc, os.path.abspath(args.output), clone=not args.no_clone))
+    logging.info('Wrote emu snapshot %s (library revision %s)', args.output, metadata['library_revision'])
+
+
+if __name__ == '__main__':
+    main()
@@ -1,21 +1,107 @@
+import asyncio
+from collections import OrderedDict
+from datetime import datetime, timezone
 import glob
+import hashlib
 import json
 import os
 import uuid
 import yaml
+import zipfile
 from aiohttp import web
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 import shutil
-from subprocess import DEVNULL, PIPE, STDOUT, check_call, Popen, CalledProcessError
+from subprocess import CalledProcessError
 import sys
+import tarfile
+import tempfile
+import time
 
 from app.utility.base_service import BaseService
 from app.utility.base_world import BaseWorld
+from plugins.emu.app import emu_metrics, emu_snapshot
+from plugins.emu.app.ingestion_writer import IngestionWriter
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import pyminizip
+except ImportError:
+    pyminizip = None
+
+
+def decode_json(data):
+    """Decode JSON using orjson when it is installed, falling back to the standard library."""
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def parse_emulation_plan(filename):
+    """Parse an emulation plan file and return it with the time spent parsing it. Defined at module level so it can
+    run in a worker process."""
+    start = time.perf_counter()
+    return BaseWorld.strip_yml(filename)[0], time.perf_counter() - start
+
+
+def find_encrypted_archives(plan_path):
+    archives = []
+    for dirpath, dirnames, filenames in os.walk(plan_path):
+        dirnames.sort()
+        archives.extend(os.path.join(dirpath, filename) for filename in sorted(filenames) if filename.endswith('.zip'))
+    return archives
+
+
+def get_archive_members(archive_path):
+    """
+    Return the file members of an archive with their target paths next to the archive. Raises ValueError if a
+    member would be extracted outside of the archive's directory.
+    """
+    target_dir = os.path.realpath(os.path.dirname(archive_path))
+    members = []
+    with zipfile.ZipFile(archive_path) as archive:
+        for member in archive.infolist():
+            if member.is_dir():
+                continue
+            target_path = os.path.realpath(os.path.join(target_dir, member.filename))
+            if os.path.commonpath([target_dir, target_path]) != target_dir:
+                raise ValueError('Archive member %s in %s would be extracted outside of %s'
+                                 % (member.filename, archive_path, target_dir))
+            members.append((member, target_path))
+    return members
+
+
+def uncompress_encrypted_archives(plan_path, password):
+    """
+    Extract every encrypted archive under a plan's Resources directory next to the archive using pyminizip.
+    Defined at module level so it can run in a worker process, since pyminizip.uncompress changes the working
+    directory of the process that calls it.
+    """
+    for archive_path in find_encrypted_archives(plan_path):
+        get_archive_members(archive_path)
+        pyminizip.uncompress(archive_path, password, os.path.dirname(os.path.abspath(archive_path)), 0)
 
 
 class EmuService(BaseService):
     _dynamicically_compiled_payloads = {'sandcat.go-linux', 'sandcat.go-darwin', 'sandcat.go-windows'}
-    _emu_config_path = "conf/default.yml"
+    _emu_config_path = os.path.join('plugins', 'emu', 'conf', 'default.yml')
+    _ingestion_manifest_version = 1
+    _payload_password = 'malware'
+    _default_repo_url = 'https://github.com/center-for-threat-informed-defense/adversary_emulation_library'
+    _sparse_checkout_patterns = ('/*/Emulation_Plan/yaml/', '/*/Resources/')
+    _tarball_extensions = ('.tar', '.tar.gz', '.tgz')
+    # (forwarded beacon field, agent profile field, accepted types)
+    _beacon_fields = (
+        ('platform', 'platform', (str,)),
+        ('hostName', 'host', (str,)),
+        ('user', 'username', (str,)),
+        ('pid', 'pid', (int, str)),
+        ('ppid', 'ppid', (int, str)),
+    )
 
     def __init__(self):
         self.log = self.add_service('emu_svc', self)
@@ -23,56 +109,224 @@ class EmuService(BaseService):
         self.repo_dir = os.path.join(self.emu_dir, 'data/adversary-emulation-plans')
         self.data_dir = os.path.join(self.emu_dir, 'data')
         self.payloads_dir = os.path.join(self.emu_dir, 'payloads')
+        self.manifest_path = os.path.join(self.data_dir, 'ingestion_manifest.json')
+        self.decryption_record_path = os.path.join(self.data_dir, 'decryption_manifest.json')
+        self.decryption_records = dict()
         self.required_payloads = set()
+        self.payload_lookup_stats = dict(hits=0, misses=0)
+        self.ingestion_manifest = dict()
+        self._next_ingestion_manifest = dict()
+        self._ingestion_record = None
+        self._parsed_plans = dict()
+        self._plan_digests = dict()
+        self.generated_files = dict(abilities=[], adversaries=[], sources=[], planners=[])
+        self.ingestion_task = None
+        self.ingestion_status = dict(phase='idle', progress=dict(), errors=[], started=None, finished=None)
         BaseWorld.apply_config('emu', BaseWorld.strip_yml(self._emu_config_path)[0])
         self.evals_c2_host = self.get_config(name='emu', prop='evals_c2_host')
         self.evals_c2_port = self.get_config(name='emu', prop='evals_c2_port')
+        self.incremental_ingestion = self._get_emu_config('incremental_ingestion', True)
+        self.ingestion_workers = int(self._get_emu_config('ingestion_workers', 0))
+        self.repo_url = self._get_emu_config('repo_url', self._default_repo_url)
+        self.sparse_repo_sync = self._get_emu_config('sparse_repo_sync', False)
+        self.decrypt_concurrency = int(self._get_emu_config('decrypt_concurrency', 4))
+        self.decrypt_in_process = self._get_emu_config('decrypt_in_process', True)
+        self._decrypt_pool = None
+        self.decrypt_chunk_size = int(self._get_emu_config('decrypt_chunk_size', 1024 * 1024))
+        self.background_ingestion = self._get_emu_config('background_ingestion', False)
+        self.snapshot_path = self._get_emu_config('snapshot_path')
+        self.beacon_max_body_size = int(self._get_emu_config('beacon_max_body_size', 64 * 1024))
+        self.bulk_beacon_max_body_size = int(self._get_emu_config('bulk_beacon_max_body_size', 16 * 1024 * 1024))
+        self.bulk_beacon_concurrency = int(self._get_emu_config('bulk_beacon_concurrency', 32))
+        self.beacon_stream_concurrency = int(self._get_emu_config('beacon_stream_concurrency', 64))
+        self.beacon_queue_enabled = self._get_emu_config('beacon_queue_enabled', False)
+        self.beacon_queue_size = int(self._get_emu_config('beacon_queue_size', 10000))
+        self.beacon_workers = int(self._get_emu_config('beacon_workers', 8))
+        self.beacon_drain_rate = float(self._get_emu_config('beacon_drain_rate', 0))
+        self.beacon_retry_after = int(self._get_emu_config('beacon_retry_after', 1))
+        self.beacon_queue = None
+        self._beacon_workers = []
+        self.beacon_coalesce_window = float(self._get_emu_config('beacon_coalesce_window', 0))
+        self.beacon_coalesce_max_entries = int(self._get_emu_config('beacon_coalesce_max_entries', 10000))
+        self._coalesced_beacons = OrderedDict()
+        self.writer = IngestionWriter(self.log,
+                                      max_workers=int(self._get_emu_config('ingestion_writer_threads', 4)),
+                                      batch_size=int(self._get_emu_config('ingestion_writer_batch_size', 64)))
         self.app_svc = self.get_service('app_svc')
         self.contact_svc = self.get_service('contact_svc')
         if not self.app_svc:
             self.log.error('App svc not found.')
         else:
             self.app_svc.application.router.add_route('POST', '/plugins/emu/beacons', self.handle_forwarded_beacon)
+            self.app_svc.application.router.add_route('POST', '/plugins/emu/beacons/bulk',
+                                                      self.handle_forwarded_beacons)
+            self.app_svc.application.router.add_route('GET', '/plugins/emu/beacons/ws', self.handle_beacon_stream)
+            self.app_svc.application.router.add_route('GET', '/plugins/emu/status', self.handle_status)
+            self.app_svc.application.router.add_route('GET', '/plugins/emu/metrics', self.handle_metrics)
 
     async def handle_forwarded_beacon(self, request):
+        with emu_metrics.beacon_request_seconds.time(endpoint='single'):
+            try:
+                profile = self._get_beacon_profile(decode_json(await self._read_body(request,
+                                                                                     self.beacon_max_body_size)))
+            except ValueError as e:
+                error_msg = 'Invalid forwarded beacon: %s' % e
+                self.log.error(error_msg)
+                emu_metrics.beacons_total.inc(endpoint='single', status='invalid')
+                raise web.HTTPBadRequest(text=error_msg)
+            try:
+                if self.beacon_queue_enabled:
+                    self._queue_beacon(profile)
+                    emu_metrics.beacons_total.inc(endpoint='single', status='queued')
+                    return web.Response(status=202, text='Queued forwarded beacon with session ID %s' % profile['paw'])
+                await self._handle_beacon(profile)
+                emu_metrics.beacons_total.inc(endpoint='single', status='ok')
+                response = 'Successfully processed forwarded beacon with session ID %s' % profile['paw']
+                return web.Response(text=response)
+            except asyncio.QueueFull:
+                self.log.warning('Beacon queue is full. Rejecting forwarded beacon.')
+                emu_metrics.beacons_total.inc(endpoint='single', status='rejected')
+                raise web.HTTPTooManyRequests(text='Beacon queue is full', headers=self._get_retry_after_header())
+            except Exception as e:
+                error_msg = 'Server error when processing forwarded beacon: %s' % e
+                self.log.error(error_msg)
+                emu_metrics.beacons_total.inc(endpoint='single', status='error')
+                raise web.HTTPBadRequest(text=error_msg)
+
+    async def handle_forwarded_beacons(self, request):
+        """
+        Process a batch of forwarded beacons, sent either as a JSON array or as newline-delimited JSON.
+        Each beacon is processed independently and the response reports the outcome of every item.
+        """
+        with emu_metrics.beacon_request_seconds.time(endpoint='bulk'):
+            try:
+                body = await self._read_body(request, self.bulk_beacon_max_body_size)
+                forwarded_profiles = self._decode_beacon_batch(body, request.content_type)
+            except ValueError as e:
+                error_msg = 'Could not decode forwarded beacons: %s' % e
+                self.log.error(error_msg)
+                raise web.HTTPBadRequest(text=error_msg)
+            semaphore = asyncio.Semaphore(max(1, self.bulk_beacon_concurrency))
+
+            async def _process(index, forwarded_profile):
+                async with semaphore:
+                    return await self._process_forwarded_beacon(index, forwarded_profile, endpoint='bulk')
+            results = await asyncio.gather(*(_process(i, p) for i, p in enumerate(forwarded_profiles)))
+            failed = sum(1 for result in results if result['status'] not in ('ok', 'queued'))
+            headers = None
+            if any(result['status'] == 'rejected' for result in results):
+                headers = self._get_retry_after_header()
+            return web.json_response(dict(processed=len(results) - failed, failed=failed, results=results),
+                                     headers=headers)
+
+    async def handle_beacon_stream(self, request):
+        """
+        Accept a persistent WebSocket connection from a redirector. Every text frame carries one forwarded
+        beacon, and is acknowledged with a JSON frame holding the frame's sequence number on the connection
+        (`index`) and its result. Frames are processed concurrently, so acknowledgements may arrive out of order.
+        """
+        ws = web.WebSocketResponse(max_msg_size=self.beacon_max_body_size, heartbeat=30)
+        await ws.prepare(request)
+        semaphore = asyncio.Semaphore(max(1, self.beacon_stream_concurrency))
+        send_lock = asyncio.Lock()
+        pending = set()
+
+        async def _acknowledge(index, data):
+            try:
+                with emu_metrics.beacon_request_seconds.time(endpoint='stream'):
+                    try:
+                        forwarded_profile = decode_json(data)
+                    except ValueError as e:
+                        forwarded_profile = ValueError('invalid JSON: %s' % e)
+                    result = await self._process_forwarded_beacon(index, forwarded_profile, endpoint='stream')
+                    async with send_lock:
+                        if not ws.closed:
+                            await ws.send_json(result)
+            except ConnectionError as e:
+                self.log.debug('Could not acknowledge streamed beacon %d: %s', index, e)
+            finally:
+                semaphore.release()
+
+        index = 0
+        async for msg in ws:
+            if msg.type not in (web.WSMsgType.TEXT, web.WSMsgType.BINARY):
+                continue
+            await semaphore.acquire()
+            task = asyncio.get_running_loop().create_task(_acknowledge(index, msg.data))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+            index += 1
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+        self.log.debug('Beacon stream closed after %d beacons', index)
+        return ws
+
+    async def handle_status(self, request):
+        status = dict(self.ingestion_status, ready=self.ingestion_status['phase'] == 'ready',
+                      payloads=self.payload_lookup_stats)
+        return web.json_response(status, status=200 if status['ready'] else 503)
+
+    async def handle_metrics(self, request):
+        return web.Response(body=emu_metrics.metrics.render().encode(),
+                            headers={'Content-Type': emu_metrics.CONTENT_TYPE})
+
+    async def ingest(self):
+        """
+        Clone the Adversary Emulation Library if needed, decrypt its payloads and populate the 'data'
+        directory, recording the current phase and progress in `ingestion_status`.
+        """
+        self.ingestion_status.update(phase='starting', progress=dict(), errors=[], started=time.time(), finished=None)
         try:
-            forwarded_profile = json.loads(await request.read())
-            profile = dict()
-            profile['paw'] = forwarded_profile.get('guid')
-            profile['contact'] = 'http'
-            profile['group'] = 'evals'
-            if 'platform' in forwarded_profile:
-                profile['platform'] = forwarded_profile.get('platform')
-            else:
-                profile['platform'] = 'evals'
-            if 'hostName' in forwarded_profile:
-                profile['host'] = forwarded_profile.get('hostName')
-            if 'user' in forwarded_profile:
-                profile['username'] = forwarded_profile.get('user')
-            if 'pid' in forwarded_profile:
-                profile['pid'] = forwarded_profile.get('pid')
-            if 'ppid' in forwarded_profile:
-                profile['ppid'] = forwarded_profile.get('ppid')
-            await self.contact_svc.handle_heartbeat(**profile)
-            response = 'Successfully processed forwarded beacon with session ID %s' % profile['paw']
-            return web.Response(text=response)
+            if self.sparse_repo_sync or not os.path.isdir(self.repo_dir):
+                self._set_ingestion_phase('cloning')
+                await self.clone_repo()
+            self._set_ingestion_phase('decrypting')
+            await self.decrypt_payloads()
+            self._set_ingestion_phase('ingesting')
+            await self.populate_data_directory()
+            self._set_ingestion_phase('ready')
         except Exception as e:
-            error_msg = 'Server error when processing forwarded beacon: %s' % e
-            self.log.error(error_msg)
-            raise web.HTTPBadRequest(error_msg)
+            self.ingestion_status['errors'].append('%s: %s' % (type(e).__name__, e))
+            self._set_ingestion_phase('failed')
+            raise
+        finally:
+            self.ingestion_status['finished'] = time.time()
+
+    def start_background_ingestion(self):
+        """Run ingestion as a tracked background task so that Caldera can finish starting up."""
+        if self.ingestion_task and not self.ingestion_task.done():
+            return self.ingestion_task
+        self.ingestion_task = asyncio.get_running_loop().create_task(self._ingest_in_background())
+        return self.ingestion_task
+
+    async def install_snapshot(self, snapshot_path):
+        """
+        Install a snapshot built by the emu_snapshot command line entry point in place of ingestion.
+        Returns True if the snapshot is installed, or False if it is missing, corrupt or incompatible.
+        """
+        installed = await asyncio.to_thread(self._install_snapshot, snapshot_path)
+        if installed:
+            self._set_ingestion_phase('ready')
+        return installed
 
     async def clone_repo(self, repo_url=None):
         """
         Clone the Adversary Emulation Library repository. You can use a specific url via
         the `repo_url` parameter (eg. if you want to use a fork).
+
+        When `sparse_repo_sync` is enabled, only the emulation plan yaml and Resources directories are
+        checked out, and an existing checkout is updated in place with a shallow fetch. The url may
+        also point to a local bare mirror or to a tarball of the library.
         """
         if not repo_url:
-            repo_url = 'https://github.com/center-for-threat-informed-defense/adversary_emulation_library'
-
-        if not os.path.exists(self.repo_dir) or not os.listdir(self.repo_dir):
-            self.log.debug('cloning repo %s' % repo_url)
-            check_call(['git', 'clone', '--depth', '1', repo_url, self.repo_dir], stdout=DEVNULL, stderr=STDOUT)
-            self.log.debug('clone complete')
+            repo_url = self.repo_url
+        with emu_metrics.ingestion_phase_seconds.time(phase='clone'):
+            if self.sparse_repo_sync:
+                await self._sync_repo(repo_url)
+            elif not os.path.exists(self.repo_dir) or not os.listdir(self.repo_dir):
+                self.log.debug('cloning repo %s' % repo_url)
+                await self._run_git('clone', '--depth', '1', repo_url, self.repo_dir)
+                self.log.debug('clone complete')
 
     async def populate_data_directory(self, library_path=None):
         """
@@ -84,26 +338,31 @@ class EmuService(BaseService):
         await self._load_planners(library_path)
 
     async def decrypt_payloads(self):
+        """
+        Decrypt the payloads of every emulation plan using the plan's crypt_executables.py script.
+        Plans are decrypted concurrently, and plans whose encrypted payloads have not changed since
+        they were last decrypted are skipped.
+        """
         path_crypt_script = os.path.join(self.repo_dir, '*', 'Resources', 'utilities', 'crypt_executables.py')
-        for crypt_script in glob.iglob(path_crypt_script):
-            plan_path = crypt_script[:crypt_script.rindex('Resources') + len('Resources')]
-            self.log.debug('attempting to decrypt plan payloads from %s using %s with the password "malware"',
-                           plan_path, crypt_script)
-            process = Popen([sys.executable, crypt_script, '-i', plan_path, '-p', 'malware', '--decrypt'], stdout=PIPE)
-            with process.stdout:
-                for line in iter(process.stdout.readline, b''):
-                    if b'[-]' in line:
-                        self.log.error(line.decode('UTF-8').rstrip())
-                    else:
-                        self.log.debug(line.decode('UTF-8').rstrip())
-            exit_code = process.wait()
-            if exit_code != 0:
-                self.log.error(process.stderr)
-                raise CalledProcessError(
-                    returncode=exit_code,
-                    cmd=process.args,
-                    stderr=process.stderr
+        self.decryption_records = self._read_decryption_records()
+        semaphore = asyncio.Semaphore(max(1, self.decrypt_concurrency))
+        if self.decrypt_in_process and pyminizip:
+            self._decrypt_pool = ProcessPoolExecutor(max_workers=max(1, self.decrypt_concurrency))
+        try:
+            with emu_metrics.ingestion_phase_seconds.time(phase='decrypt'):
+                results = await asyncio.gather(
+                    *(self._decrypt_plan_payloads(crypt_script, semaphore)
+                      for crypt_script in glob.iglob(path_crypt_script)),
+                    return_exceptions=True
                 )
+        finally:
+            if self._decrypt_pool:
+                self._decrypt_pool.shutdown()
+                self._decrypt_pool = None
+        self._write_decryption_records(self.decryption_records)
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
 
     @staticmethod
     def get_adversary_from_filename(filename):
@@ -112,22 +371,468 @@ class EmuService(BaseService):
 
     """ PRIVATE """
 
+    @classmethod
+    def _get_beacon_profile(cls, forwarded_profile):
+        """Validate a decoded forwarded beacon and map it to a Caldera agent profile. Raises ValueError."""
+        if not isinstance(forwarded_profile, dict):
+            raise ValueError('expected a JSON object')
+        guid = forwarded_profile.get('guid')
+        if not isinstance(guid, str) or not guid:
+            raise ValueError("field 'guid' must be a non-empty string")
+        profile = dict(paw=guid, contact='http', group='evals', platform='evals')
+        for forwarded_field, profile_field, types in cls._beacon_fields:
+            value = forwarded_profile.get(forwarded_field)
+            if value is None:
+                continue
+            if not isinstance(value, types) or isinstance(value, bool):
+                raise ValueError("field '%s' must be of type %s" % (forwarded_field, ' or '.join(t.__name__ for t in types)))
+            if isinstance(value, str) and int in types and not value.isdigit():
+                raise ValueError("field '%s' must be an integer" % forwarded_field)
+            profile[profile_field] = value
+        return profile
+
+    @staticmethod
+    async def _read_body(request, max_size):
+        """Read the request body, raising 413 as soon as it exceeds `max_size` bytes."""
+        if request.content_length is not None and request.content_length > max_size:
+            raise web.HTTPRequestEntityTooLarge(max_size=max_size, actual_size=request.content_length)
+        body = bytearray()
+        while True:
+            chunk = await request.content.readany()
+            if not chunk:
+                return bytes(body)
+            body.extend(chunk)
+            if len(body) > max_size:
+                raise web.HTTPRequestEntityTooLarge(max_size=max_size, actual_size=len(body))
+
+    @staticmethod
+    def _decode_beacon_batch(body, content_type):
+        """
+        Decode a JSON array or newline-delimited JSON batch of forwarded beacons. Lines of newline-delimited
+        JSON that cannot be decoded are returned as ValueError instances so they fail individually.
+        """
+        if content_type != 'application/x-ndjson' and body.lstrip().startswith(b'['):
+            forwarded_profiles = decode_json(body)
+            if not isinstance(forwarded_profiles, list):
+                raise ValueError('expected a JSON array of beacons')
+            return forwarded_profiles
+        forwarded_profiles = []
+        for line in body.splitlines():
+            if not line.strip():
+                continue
+            try:
+                forwarded_profiles.append(decode_json(line))
+            except ValueError as e:
+                forwarded_profiles.append(ValueError('invalid JSON: %s' % e))
+        return forwarded_profiles
+
+    async def _process_forwarded_beacon(self, index, forwarded_profile, endpoint='bulk'):
+        """Process one decoded beacon from a batch or stream, returning its result instead of raising."""
+        result = await self._get_forwarded_beacon_result(index, forwarded_profile)
+        emu_metrics.beacons_total.inc(endpoint=endpoint, status=result['status'])
+        return result
+
+    async def _get_forwarded_beacon_result(self, index, forwarded_profile):
+        try:
+            if isinstance(forwarded_profile, Exception):
+                raise forwarded_profile
+            profile = self._get_beacon_profile(forwarded_profile)
+            if self.beacon_queue_enabled:
+                self._queue_beacon(profile)
+                return dict(index=index, paw=profile['paw'], status='queued')
+            await self._handle_beacon(profile)
+            return dict(index=index, paw=profile['paw'], status='ok')
+        except asyncio.QueueFull:
+            return dict(index=index, status='rejected', error='beacon queue is full')
+        except Exception as e:
+            self.log.error('Server error when processing forwarded beacon %d: %s', index, e)
+            return dict(index=index, status='error', error=str(e))
+
+    async def _handle_beacon(self, profile):
+        """
+        Run the heartbeat for a forwarded beacon. When coalescing is enabled, a beacon identical to the last
+        one seen for the same session within the coalescing window only refreshes the agent's last seen
+        time and reuses the outcome of the previous heartbeat.
+        """
+        if not self.beacon_coalesce_window:
+            with emu_metrics.beacon_heartbeat_seconds.time():
+                return await self.contact_svc.handle_heartbeat(**profile)
+        now = time.monotonic()
+        previous = self._coalesced_beacons.get(profile['paw'])
+        if previous and previous['profile'] == profile and now - previous['time'] < self.beacon_coalesce_window:
+            self._coalesced_beacons.move_to_end(profile['paw'])
+            self._refresh_last_seen(previous['result'])
+            emu_metrics.beacons_coalesced_total.inc()
+            return previous['result']
+        with emu_metrics.beacon_heartbeat_seconds.time():
+            result = await self.contact_svc.handle_heartbeat(**profile)
+        self._coalesced_beacons[profile['paw']] = dict(profile=dict(profile), time=now, result=result)
+        self._coalesced_beacons.move_to_end(profile['paw'])
+        while len(self._coalesced_beacons) > self.beacon_coalesce_max_entries:
+            self._coalesced_beacons.popitem(last=False)
+        return result
+
+    @staticmethod
+    def _refresh_last_seen(heartbeat_result):
+        agent = heartbeat_result[0] if isinstance(heartbeat_result, tuple) and heartbeat_result else None
+        last_seen = getattr(agent, 'last_seen', None)
+        if isinstance(last_seen, datetime):
+            now = datetime.now(timezone.utc)
+            agent.last_seen = now if last_seen.tzinfo else now.replace(tzinfo=None)
+
+    def _queue_beacon(self, profile):
+        """Queue a beacon for the worker pool. Raises asyncio.QueueFull when the queue is at capacity."""
+        if self.beacon_queue is None:
+            self.beacon_queue = asyncio.Queue(maxsize=self.beacon_queue_size)
+            loop = asyncio.get_running_loop()
+            self._beacon_workers = [loop.create_task(self._drain_beacon_queue())
+                                    for _ in range(max(1, self.beacon_workers))]
+        self.beacon_queue.put_nowait(profile)
+
+    async def _drain_beacon_queue(self):
+        interval = max(1, self.beacon_workers) / self.beacon_drain_rate if self.beacon_drain_rate else 0
+        while True:
+            profile = await self.beacon_queue.get()
+            try:
+                await self._handle_beacon(profile)
+            except Exception as e:
+                self.log.error('Server error when processing queued beacon with session ID %s: %s', profile['paw'], e)
+            finally:
+                self.beacon_queue.task_done()
+            if interval:
+                await asyncio.sleep(interval)
+
+    def _get_retry_after_header(self):
+        return {'Retry-After': str(self.beacon_retry_after)}
+
+    async def _ingest_in_background(self):
+        try:
+            await self.ingest()
+        except Exception as e:
+            self.log.error('Background ingestion failed: %s', e)
+            return
+        await self._load_generated_files()
+
+    async def _load_generated_files(self):
+        """Load files generated by background ingestion, since Caldera has already loaded the plugin data."""
+        data_svc = self.get_service('data_svc')
+        if not data_svc:
+            self.log.warning('Data svc not found. Generated emu data will be loaded on the next restart.')
+            return
+        loaders = dict(abilities=getattr(data_svc, 'load_ability_file', None),
+                       adversaries=getattr(data_svc, 'load_adversary_file', None),
+                       sources=getattr(data_svc, 'load_source_file', None))
+        for kind, loader in loaders.items():
+            for file_path in self.generated_files[kind]:
+                try:
+                    if loader:
+                        await loader(file_path, BaseWorld.Access.RED)
+                except Exception as e:
+                    self.log.error('Failed to load generated %s file %s: %s', kind, file_path, e)
+        if self.generated_files['planners']:
+            self.log.info('Loaded emu data generated in the background. New planners are available after a restart.')
+
+    def _set_ingestion_phase(self, phase):
+        self.log.debug('Ingestion phase: %s', phase)
+        self.ingestion_status['phase'] = phase
+
+    def _track_generated_file(self, kind, file_path, written):
+        written.add_done_callback(
+            lambda f: self.generated_files[kind].append(file_path) if not f.exception() and f.result() else None
+        )
+
+    def _install_snapshot(self, snapshot_path):
+        try:
+            checksum = emu_snapshot.read_checksum(snapshot_path)
+        except (OSError, IndexError) as e:
+            self.log.warning('Could not read the checksum of snapshot %s: %s', snapshot_path, e)
+            return False
+        marker_path = os.path.join(self.data_dir, '.emu_snapshot')
+        installed = self._read_snapshot_marker(marker_path)
+        if installed.get('checksum') == checksum:
+            if all(os.path.exists(path) for path in installed.get('files', [])):
+                self.log.debug('Snapshot %s is already installed.', snapshot_path)
+                return True
+            self.log.warning('Files installed from snapshot %s are missing. Reinstalling it.', snapshot_path)
+        staging_dir = None
+        try:
+            if emu_snapshot.compute_checksum(snapshot_path) != checksum:
+                self.log.error('Checksum mismatch for snapshot %s. Ignoring it.', snapshot_path)
+                return False
+            staging_dir = self._make_snapshot_staging_dir()
+            staged_files = self._extract_snapshot(snapshot_path, staging_dir)
+            if staged_files is None:
+                return False
+            # Every file is extracted before any is moved into place, so an invalid snapshot leaves the tree as is.
+            if os.path.exists(marker_path):
+                os.remove(marker_path)
+            for staged_path, target_path in staged_files:
+                os.makedirs(os.path.dirname(target_path), exist_ok=True)
+                os.replace(staged_path, target_path)
+        except (KeyError, ValueError, tarfile.TarError) as e:
+            self.log.error('Snapshot %s is not a valid emu snapshot. Ignoring it: %s', snapshot_path, e)
+            return False
+        except OSError as e:
+            self.log.error('Could not install snapshot %s: %s', snapshot_path, e)
+            return False
+        finally:
+            if staging_dir:
+                shutil.rmtree(staging_dir, ignore_errors=True)
+        os.makedirs(self.data_dir, exist_ok=True)
+        with open(marker_path, 'w') as f:
+            json.dump(dict(checksum=checksum, files=[target_path for _, target_path in staged_files]), f, indent=2)
+        return True
+
+    def _make_snapshot_staging_dir(self):
+        """Create the directory a snapshot is extracted to, next to the data directory so files can be renamed into
+        place."""
+        parent_dir = os.path.dirname(os.path.abspath(self.data_dir))
+        os.makedirs(parent_dir, exist_ok=True)
+        return tempfile.mkdtemp(prefix='.emu_snapshot_', dir=parent_dir)
+
+    def _extract_snapshot(self, snapshot_path, staging_dir):
+        """Extract a snapshot into the staging directory and return the (staged path, target path) pairs of its files,
+        or None if its format is unsupported."""
+        staged_files = []
+        with tarfile.open(snapshot_path) as snapshot:
+            metadata = json.load(snapshot.extractfile(emu_snapshot.SNAPSHOT_METADATA))
+            if metadata.get('format_version') != emu_snapshot.SNAPSHOT_FORMAT_VERSION:
+                self.log.warning('Snapshot %s has unsupported format version %s. Ignoring it.',
+                                 snapshot_path, metadata.get('format_version'))
+                return None
+            self.log.debug('Installing snapshot %s of library revision %s', snapshot_path,
+                           metadata.get('library_revision'))
+            for member in snapshot.getmembers():
+                target_path = self._get_snapshot_target_path(member.name)
+                if not target_path or not member.isfile():
+                    continue
+                staged_path = os.path.join(staging_dir, *member.name.split('/'))
+                os.makedirs(os.path.dirname(staged_path), exist_ok=True)
+                with snapshot.extractfile(member) as src, open(staged_path, 'wb') as dst:
+                    shutil.copyfileobj(src, dst)
+                staged_files.append((staged_path, target_path))
+        return staged_files
+
+    def _read_snapshot_marker(self, marker_path):
+        try:
+            with open(marker_path, 'r') as f:
+                marker = json.load(f)
+            return marker if isinstance(marker, dict) else dict()
+        except FileNotFoundError:
+            return dict()
+        except Exception as e:
+            self.log.debug('Could not read snapshot marker %s: %s', marker_path, e)
+            return dict()
+
+    def _get_snapshot_target_path(self, member_name):
+        parts = member_name.split('/')
+        if '..' in parts or member_name.startswith('/') or len(parts) < 2:
+            return None
+        if parts[0] == 'data' and parts[1] in emu_snapshot.SNAPSHOT_DATA_DIRS:
+            return os.path.join(self.data_dir, *parts[1:])
+        if parts[0] == 'payloads':
+            return os.path.join(self.payloads_dir, *parts[1:])
+        return None
+
+    async def _sync_repo(self, repo_url):
+        if repo_url.endswith(self._tarball_extensions) and os.path.isfile(repo_url):
+            await asyncio.to_thread(self._extract_repo_tarball, repo_url)
+        elif os.path.isdir(os.path.join(self.repo_dir, '.git')):
+            self.log.debug('updating repo %s from %s', self.repo_dir, repo_url)
+            try:
+                await self._run_git('-C', self.repo_dir, 'fetch', '--depth', '1', repo_url, 'HEAD')
+                await self._run_git('-C', self.repo_dir, 'reset', '--hard', 'FETCH_HEAD')
+                self.log.debug('update complete')
+            except CalledProcessError as e:
+                self.log.warning('Failed to update %s, using the existing checkout: %s', self.repo_dir, e)
+        elif not os.path.exists(self.repo_dir) or not os.listdir(self.repo_dir):
+            self.log.debug('sparse cloning repo %s' % repo_url)
+            await self._run_git('clone', '--depth', '1', '--filter=blob:none', '--no-checkout', repo_url, self.repo_dir)
+            await self._run_git('-C', self.repo_dir, 'sparse-checkout', 'set', '--no-cone',
+                                *self._sparse_checkout_patterns)
+            await self._run_git('-C', self.repo_dir, 'checkout')
+            self.log.debug('clone complete')
+        else:
+            self.log.warning('%s is not a git checkout. Skipping repo sync.', self.repo_dir)
+
+    async def _run_git(self, *args):
+        process = await asyncio.create_subprocess_exec('git', *args, stdout=asyncio.subprocess.DEVNULL,
+                                                       stderr=asyncio.subprocess.PIPE)
+        _, stderr = await process.communicate()
+        if process.returncode != 0:
+            self.log.debug('git %s failed: %s', ' '.join(args), stderr.decode('UTF-8', errors='replace').rstrip())
+            raise CalledProcessError(returncode=process.returncode, cmd=['git', *args], stderr=stderr)
+
+    def _extract_repo_tarball(self, tarball_path):
+        """Extract the emulation plan yaml and Resources directories from a tarball of the library."""
+        stat = os.stat(tarball_path)
+        fingerprint = '%s:%d:%d' % (os.path.abspath(tarball_path), stat.st_size, stat.st_mtime_ns)
+        marker_path = os.path.join(self.repo_dir, '.emu_tarball')
+        if os.path.exists(marker_path):
+            with open(marker_path, 'r') as f:
+                if f.read() == fingerprint:
+                    self.log.debug('Repo %s is already extracted from %s. Skipping.', self.repo_dir, tarball_path)
+                    return
+        self.log.debug('extracting repo tarball %s', tarball_path)
+        with tarfile.open(tarball_path) as tarball:
+            members = [m for m in tarball.getmembers() if m.isfile() or m.isdir()]
+            top_level = {m.name.split('/', 1)[0] for m in members}
+            strip_prefix = len(top_level) == 1 and not any(m.isfile() and '/' not in m.name for m in members)
+            for member in members:
+                parts = member.name.split('/')[1 if strip_prefix else 0:]
+                if not self._is_sparse_repo_path(parts) or '..' in parts or member.name.startswith('/'):
+                    continue
+                target_path = os.path.join(self.repo_dir, *parts)
+                if member.isdir():
+                    os.makedirs(target_path, exist_ok=True)
+                    continue
+                os.makedirs(os.path.dirname(target_path), exist_ok=True)
+                with tarball.extractfile(member) as src, open(target_path, 'wb') as dst:
+                    shutil.copyfileobj(src, dst)
+        with open(marker_path, 'w') as f:
+            f.write(fingerprint)
+        self.log.debug('extraction complete')
+
+    @staticmethod
+    def _is_sparse_repo_path(parts):
+        return (len(parts) > 3 and parts[1:3] == ['Emulation_Plan', 'yaml']) or (len(parts) > 2 and parts[1] == 'Resources')
+
+    async def _decrypt_plan_payloads(self, crypt_script, semaphore):
+        plan_path = crypt_script[:crypt_script.rindex('Resources') + len('Resources')]
+        fingerprint = await asyncio.to_thread(self._fingerprint_encrypted_payloads, plan_path, crypt_script)
+        if self.decryption_records.get(plan_path) == fingerprint:
+            self.log.debug('Payloads from %s are already decrypted. Skipping.', plan_path)
+            return
+        async with semaphore:
+            decrypted = False
+            if self.decrypt_in_process:
+                try:
+                    await self._decrypt_in_process(plan_path)
+                    decrypted = True
+                except Exception as e:
+                    self.log.warning('Failed to decrypt plan payloads from %s in process, falling back to %s: %s',
+                                     plan_path, crypt_script, e)
+            if not decrypted:
+                await self._run_crypt_script(crypt_script, plan_path)
+        self.decryption_records[plan_path] = await asyncio.to_thread(self._fingerprint_encrypted_payloads,
+                                                                     plan_path, crypt_script)
+
+    async def _run_crypt_script(self, crypt_script, plan_path):
+        self.log.debug('attempting to decrypt plan payloads from %s using %s with the password "%s"',
+                       plan_path, crypt_script, self._payload_password)
+        args = [sys.executable, crypt_script, '-i', plan_path, '-p', self._payload_password, '--decrypt']
+        process = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.PIPE,
+                                                       stderr=asyncio.subprocess.STDOUT)
+        async for line in process.stdout:
+            if b'[-]' in line:
+                self.log.error(line.decode('UTF-8').rstrip())
+            else:
+                self.log.debug(line.decode('UTF-8').rstrip())
+        exit_code = await process.wait()
+        if exit_code != 0:
+            self.log.error('Failed to decrypt plan payloads from %s (exit code %d)', plan_path, exit_code)
+            raise CalledProcessError(returncode=exit_code, cmd=args)
+
+    async def _decrypt_in_process(self, plan_path):
+        self.log.debug('attempting to decrypt plan payloads from %s in process with the password "%s"',
+                       plan_path, self._payload_password)
+        if self._decrypt_pool:
+            await asyncio.get_running_loop().run_in_executor(self._decrypt_pool, uncompress_encrypted_archives,
+                                                             plan_path, self._payload_password)
+        else:
+            await asyncio.to_thread(self._decrypt_archives_in_process, plan_path)
+
+    def _decrypt_archives_in_process(self, plan_path):
+        """Extract every encrypted archive under the plan's Resources directory next to the archive."""
+        for archive_path in find_encrypted_archives(plan_path):
+            self._extract_encrypted_archive(archive_path)
+
+    def _extract_encrypted_archive(self, archive_path):
+        """
+        Stream each archive member to disk in fixed-size chunks so memory use does not grow with payload size.
+        This is the fallback when pyminizip is not installed: zipfile decrypts in pure Python, so it is much slower.
+        """
+        with zipfile.ZipFile(archive_path) as archive:
+            for member, target_path in get_archive_members(archive_path):
+                os.makedirs(os.path.dirname(target_path), exist_ok=True)
+                partial_path = '%s.part' % target_path
+                with archive.open(member, pwd=self._payload_password.encode()) as src, open(partial_path, 'wb') as dst:
+                    shutil.copyfileobj(src, dst, self.decrypt_chunk_size)
+                os.replace(partial_path, target_path)
+                self.log.debug('[+] Decrypted %s from %s', target_path, archive_path)
+
+    @staticmethod
+    def _fingerprint_encrypted_payloads(plan_path, crypt_script):
+        """Fingerprint the decryption script and the encrypted archives under a plan's Resources directory."""
+        sha256 = hashlib.sha256()
+        stat = os.stat(crypt_script)
+        sha256.update(('%s:%d:%d;' % (crypt_script, stat.st_size, stat.st_mtime_ns)).encode())
+        for dirpath, dirnames, filenames in os.walk(plan_path):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if filename.endswith('.zip'):
+                    path = os.path.join(dirpath, filename)
+                    stat = os.stat(path)
+                    sha256.update(('%s:%d:%d;' % (path, stat.st_size, stat.st_mtime_ns)).encode())
+        return sha256.hexdigest()
+
+    def _read_decryption_records(self):
+        try:
+            with open(self.decryption_record_path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return dict()
+        except Exception as e:
+            self.log.warning('Could not read decryption records %s: %s', self.decryption_record_path, e)
+            return dict()
+
+    def _write_decryption_records(self, records):
+        try:
+            os.makedirs(os.path.dirname(self.decryption_record_path), exist_ok=True)
+            with open(self.decryption_record_path, 'w') as f:
+                json.dump(records, f, indent=2, sort_keys=True)
+        except Exception as e:
+            self.log.error('Failed to write decryption records %s: %s', self.decryption_record_path, e)
+
+    def _get_emu_config(self, prop, default=None):
+        value = self.get_config(name='emu', prop=prop)
+        return default if value is None else value
+
     async def _load_adversaries_and_abilities(self, library_path):
         adv_emu_plan_path = os.path.join(library_path, 'Emulation_Plan', 'yaml', '*.yaml')
-        await self._load_object(adv_emu_plan_path, 'abilities', self._ingest_emulation_plan)
-        self._store_required_payloads()
+        if self.incremental_ingestion:
+            self.ingestion_manifest = self._read_ingestion_manifest()
+            self._next_ingestion_manifest = dict()
+            await self._load_object(adv_emu_plan_path, 'abilities', self._ingest_emulation_plan_if_changed,
+                                    prepare_func=self._parse_emulation_plans)
+            self._write_ingestion_manifest(self._next_ingestion_manifest)
+        else:
+            await self._load_object(adv_emu_plan_path, 'abilities', self._ingest_emulation_plan,
+                                    prepare_func=self._parse_emulation_plans)
+        self._parsed_plans.clear()
+        self._plan_digests.clear()
+        with emu_metrics.ingestion_phase_seconds.time(phase='payload_copy'):
+            self._store_required_payloads()
 
     async def _load_planners(self, library_path):
         planner_path = os.path.join(library_path, 'Emulation_Plan', 'yaml', 'planners', '*.yml')
         await self._load_object(planner_path, 'planners', self._ingest_planner)
 
-    async def _load_object(self, search_path, object_name, ingestion_func):
+    async def _load_object(self, search_path, object_name, ingestion_func, prepare_func=None):
         total, ingested, errors = 0, 0, 0
-        for filename in glob.iglob(search_path):
+        filenames = list(glob.iglob(search_path))
+        progress = dict(files_total=len(filenames), files_processed=0, total=0, ingested=0, errors=0)
+        self.ingestion_status['progress'][object_name] = progress
+        if prepare_func:
+            await prepare_func(filenames)
+        for filename in filenames:
             total_obj, ingested_obj, num_errors = await ingestion_func(filename)
             total += total_obj
             ingested += ingested_obj
             errors += num_errors
+            progress.update(files_processed=progress['files_processed'] + 1, total=total, ingested=ingested,
+                            errors=errors)
+        await self.writer.flush()
         errors_output = f' and ran into {errors} errors' if errors else ''
         self.log.debug(f'Ingested {ingested} {object_name} (out of {total}) from emu plugin{errors_output}')
 
@@ -141,7 +846,7 @@ class EmuService(BaseService):
                 planner_id = planner_contents['id']
                 target_filename = '%s.yml' % planner_id
                 try:
-                    self._copy_planner(filename, target_filename)
+                    await self._copy_planner(filename, target_filename)
                     num_ingested += 1
                 except IOError as e:
                     self.log.error('Error copying planner file to %s', target_filename, e)
@@ -154,24 +859,47 @@ class EmuService(BaseService):
             num_errors += 1
         return num_planners, num_ingested, num_errors
 
-    def _copy_planner(self, source_path, target_filename):
-        planner_dir = os.path.join(self.data_dir, 'planners')
-        if not os.path.exists(planner_dir):
-            os.makedirs(planner_dir)
-        target_path = os.path.join(planner_dir, target_filename)
-        if os.path.exists(target_path):
-            self.log.debug('Planner %s already exists. Skipping.', target_path)
-        else:
-            shutil.copyfile(source_path, target_path)
+    async def _copy_planner(self, source_path, target_filename):
+        target_path = os.path.join(self.data_dir, 'planners', target_filename)
+        copied = self.writer.copy(source_path, target_path)
+        self._track_generated_file('planners', target_path, copied)
+        await self.writer.flush()
+        if await copied:
             self.log.debug('Copied planner to %s', target_path)
 
     @staticmethod
     def _is_planner(data):
         return {'id', 'module'}.issubset(set(data.keys()))
 
+    async def _parse_emulation_plans(self, filenames):
+        """Parse the given emulation plans in a bounded process pool when parallel ingestion is enabled.
+        Parsed plans are consumed in their original order by _ingest_emulation_plan, so the generated
+        data is identical to a serial run. Plans that fail to parse are left for the serial path."""
+        if self.incremental_ingestion:
+            filenames = [f for f in filenames if not self._get_unchanged_record(f)]
+        if self.ingestion_workers < 2 or len(filenames) < 2:
+            return
+        self.log.debug('Parsing %d emulation plans using %d worker processes', len(filenames), self.ingestion_workers)
+        loop = asyncio.get_running_loop()
+        with ProcessPoolExecutor(max_workers=min(self.ingestion_workers, len(filenames))) as pool:
+            results = await asyncio.gather(
+                *(loop.run_in_executor(pool, parse_emulation_plan, filename) for filename in filenames),
+                return_exceptions=True
+            )
+        for filename, result in zip(filenames, results):
+            if isinstance(result, Exception):
+                self.log.debug('Failed to parse %s in worker process: %s', filename, result)
+            else:
+                # Like serial parsing, record the time spent parsing each plan.
+                self._parsed_plans[filename], elapsed = result
+                emu_metrics.ingestion_phase_seconds.observe(elapsed, phase='plan_parse')
+
     async def _ingest_emulation_plan(self, filename):
         self.log.debug('Ingesting emulation plan at %s', filename)
-        emulation_plan = self.strip_yml(filename)[0]
+        emulation_plan = self._parsed_plans.pop(filename, None)
+        if emulation_plan is None:
+            with emu_metrics.ingestion_phase_seconds.time(phase='plan_parse'):
+                emulation_plan = self.strip_yml(filename)[0]
         details = dict()
         for entry in emulation_plan:
             if 'emulation_plan_details' in entry:
@@ -192,6 +920,100 @@ class EmuService(BaseService):
         await self._save_source(details.get('adversary_name', filename), adversary_facts)
         return at_total, at_ingested, errors
 
+    async def _ingest_emulation_plan_if_changed(self, filename):
+        """Ingest the emulation plan only if its contents changed since the last recorded ingestion.
+        Unchanged plans whose generated files are still present are skipped entirely."""
+        record = self._get_unchanged_record(filename)
+        if record:
+            self.log.debug('Emulation plan %s is unchanged since last ingestion. Skipping.', filename)
+            self._register_required_payloads(record.get('payloads', []))
+            self._next_ingestion_manifest[filename] = record
+            return record.get('total', 0), record.get('ingested', 0), record.get('errors', 0)
+        digest = self._get_plan_digest(filename)
+        record = self.ingestion_manifest.get(filename)
+        if record:
+            self.log.debug('Emulation plan %s changed or its generated files are missing. Re-ingesting.', filename)
+            self._remove_recorded_outputs(record)
+        self._ingestion_record = dict(abilities=[], adversaries=[], sources=[], payloads=[])
+        try:
+            total, ingested, errors = await self._ingest_emulation_plan(filename)
+        finally:
+            outputs, self._ingestion_record = self._ingestion_record, None
+        self._next_ingestion_manifest[filename] = dict(
+            sha256=digest,
+            total=total,
+            ingested=ingested,
+            errors=errors,
+            abilities=sorted(set(outputs['abilities'])),
+            adversary=outputs['adversaries'][0] if outputs['adversaries'] else None,
+            source=outputs['sources'][0] if outputs['sources'] else None,
+            payloads=sorted(set(outputs['payloads']))
+        )
+        return total, ingested, errors
+
+    def _get_unchanged_record(self, filename):
+        record = self.ingestion_manifest.get(filename)
+        if record and record.get('sha256') == self._get_plan_digest(filename) and self._recorded_outputs_exist(record):
+            return record
+        return None
+
+    def _get_plan_digest(self, filename):
+        if filename not in self._plan_digests:
+            self._plan_digests[filename] = self._hash_file(filename)
+        return self._plan_digests[filename]
+
+    def _read_ingestion_manifest(self):
+        try:
+            with open(self.manifest_path, 'r') as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            return dict()
+        except Exception as e:
+            self.log.warning('Could not read ingestion manifest %s: %s', self.manifest_path, e)
+            return dict()
+        if manifest.get('version') != self._ingestion_manifest_version:
+            self.log.debug('Ingestion manifest %s has an unsupported version. Ignoring.', self.manifest_path)
+            return dict()
+        return manifest.get('plans', dict())
+
+    def _write_ingestion_manifest(self, plans):
+        try:
+            os.makedirs(os.path.dirname(self.manifest_path), exist_ok=True)
+            with open(self.manifest_path, 'w') as f:
+                json.dump(dict(version=self._ingestion_manifest_version, plans=plans), f, indent=2, sort_keys=True)
+        except Exception as e:
+            self.log.error('Failed to write ingestion manifest %s: %s', self.manifest_path, e)
+
+    @staticmethod
+    def _hash_file(filename, chunk_size=65536):
+        sha256 = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                sha256.update(chunk)
+        return sha256.hexdigest()
+
+    @staticmethod
+    def _get_recorded_outputs(record):
+        outputs = list(record.get('abilities', []))
+        outputs.extend(path for path in (record.get('adversary'), record.get('source')) if path)
+        return outputs
+
+    def _recorded_outputs_exist(self, record):
+        return all(os.path.exists(path) for path in self._get_recorded_outputs(record))
+
+    def _remove_recorded_outputs(self, record):
+        for path in self._get_recorded_outputs(record):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                self.log.warning('Failed to remove previously ingested file %s: %s', path, e)
+
+    def _record_output(self, kind, path):
+        if self._ingestion_record is not None:
+            self._ingestion_record[kind].append(path)
+
     async def _ingest_abilities(self, emulation_plan):
         """Ingests the abilities in the emulation plan and returns a tuple representing the following:
             - list of ingested ability IDs to add to the adversary profile
@@ -223,17 +1045,9 @@ class EmuService(BaseService):
             return False
 
     async def _write_adversary(self, data):
-        d = os.path.join(self.data_dir, 'adversaries')
-
-        if not os.path.exists(d):
-            os.makedirs(d)
-
-        file_path = os.path.join(d, '%s.yml' % data['id'])
-        if os.path.exists(file_path):
-            self.log.debug('Adversary profile %s already exists. Skipping.', file_path)
-        else:
-            with open(file_path, 'w') as f:
-                f.write(yaml.dump(data))
+        file_path = os.path.join(self.data_dir, 'adversaries', '%s.yml' % data['id'])
+        self._record_output('adversaries', file_path)
+        self._track_generated_file('adversaries', file_path, self.writer.write(file_path, yaml.dump(data)))
 
     async def _save_adversary(self, id, name, description, abilities):
         adversary = dict(
@@ -251,15 +1065,9 @@ class EmuService(BaseService):
         return False
 
     async def _write_ability(self, data):
-        d = os.path.join(self.data_dir, 'abilities', data['tactic'])
-        if not os.path.exists(d):
-            os.makedirs(d)
-        file_path = os.path.join(d, '%s.yml' % data['id'])
-        if os.path.exists(file_path):
-            self.log.debug('Ability file %s already exists. Skipping.', file_path)
-        else:
-            with open(file_path, 'w') as f:
-                f.write(yaml.dump([data]))
+        file_path = os.path.join(self.data_dir, 'abilities', data['tactic'], '%s.yml' % data['id'])
+        self._record_output('abilities', file_path)
+        self._track_generated_file('abilities', file_path, self.writer.write(file_path, yaml.dump([data])))
 
     @staticmethod
     def get_privilege(executors):
@@ -305,18 +1113,23 @@ class EmuService(BaseService):
         return ability['id'], facts
 
     def _register_required_payloads(self, payloads):
-        self.required_payloads.update(
-            [payload for payload in payloads if payload not in self._dynamicically_compiled_payloads]
-        )
+        required = [payload for payload in payloads if payload not in self._dynamicically_compiled_payloads]
+        self.required_payloads.update(required)
+        if self._ingestion_record is not None:
+            self._ingestion_record['payloads'].extend(required)
 
     def _store_required_payloads(self):
         self.log.debug('Searching for and storing required payloads.')
+        payload_index = None
+        hits, misses = 0, 0
         for payload in self.required_payloads:
             copied = False
             found = False
             if os.path.exists(os.path.join(self.payloads_dir, payload)):
                 continue
-            for path in Path(self.repo_dir).rglob(payload):
+            if payload_index is None:
+                payload_index = self._build_payload_index()
+            for path in self._find_payload(payload, payload_index):
                 found = True
                 target_path = os.path.join(self.payloads_dir, path.name)
                 try:
@@ -325,10 +1138,32 @@ class EmuService(BaseService):
                     break
                 except Exception as e:
                     self.log.error('Failed to copy payload %s to %s: %s.', payload, target_path, e)
-            if not found:
+            if found:
+                hits += 1
+            else:
+                misses += 1
                 self.log.warn('Could not find payload %s within %s.', payload, self.repo_dir)
-            elif not copied:
+            if found and not copied:
                 self.log.warn('Found payload %s, but could not copy it to the payloads directory.', payload)
+        self.payload_lookup_stats = dict(hits=hits, misses=misses)
+        self.log.debug('Payload lookups within %s: %d hits, %d misses', self.repo_dir, hits, misses)
+
+    def _build_payload_index(self):
+        """Walk the repository once and map each filename to the paths it appears at, in walk order."""
+        payload_index = dict()
+        for dirpath, dirnames, filenames in os.walk(self.repo_dir):
+            dirnames[:] = sorted(d for d in dirnames if d != '.git')
+            for filename in sorted(filenames):
+                payload_index.setdefault(filename, []).append(Path(dirpath, filename))
+        return payload_index
+
+    def _find_payload(self, payload, payload_index):
+        if os.sep in payload or any(c in payload for c in '*?['):
+            return Path(self.repo_dir).rglob(payload)
+        paths = payload_index.get(payload, [])
+        if len(paths) > 1:
+            self.log.debug('Found %d candidates for payload %s. Using the first available copy.', len(paths), payload)
+        return paths
 
     async def _save_source(self, name, facts):
         source = dict(
@@ -347,14 +1182,6 @@ class EmuService(BaseService):
         return unique_facts
 
     async def _write_source(self, data):
-        d = os.path.join(self.data_dir, 'sources')
-
-        if not os.path.exists(d):
-            os.makedirs(d)
-
-        file_path = os.path.join(d, '%s.yml' % data['id'])
-        if os.path.exists(file_path):
-            self.log.debug('Fact source file %s already exists. Skipping.', file_path)
-        else:
-            with open(file_path, 'w') as f:
-                f.write(yaml.dump(data))
+        file_path = os.path.join(self.data_dir, 'sources', '%s.yml' % data['id'])
+        self._record_output('sources', file_path)
+        self._track_generated_file('sources', file_path, self.writer.write(file_path, yaml.dump(data)))
@@ -1,32 +1,61 @@
+import asyncio
+import itertools
+from collections import deque
+
 from app.utility.base_world import BaseWorld
+from plugins.emu.app import emu_metrics
 
 
 class LogicalPlanner:
-    def __init__(self, operation, planning_svc, stopping_conditions=(), filtered_groups_by_ability=None):
+    def __init__(self, operation, planning_svc, stopping_conditions=(), filtered_groups_by_ability=None,
+                 link_generation_concurrency=8, pipelined=False, scheduling='sequential', independent_abilities=None):
         self.operation = operation
         self.planning_svc = planning_svc
         self.stopping_conditions = stopping_conditions
         self.stopping_condition_met = False
         self.state_machine = ['fetch_and_run_links']
         self.next_bucket = 'fetch_and_run_links'   # repeat this bucket until we run out of links.
-        self.filtered_groups_by_ability = filtered_groups_by_ability if filtered_groups_by_ability else dict()
-        self.pending_links = []
+        self.filtered_groups_by_ability = {ability_id: set(groups) for ability_id, groups
+                                           in (filtered_groups_by_ability or dict()).items()}
+        self.pending_links = dict()   # paw -> deque of links, in the order agents first appear in the pool
         self.current_ability_index = 0
+        self.link_generation_concurrency = max(1, int(link_generation_concurrency))
+        self.pipelined = pipelined
+        self._prefetch = None
+        # With 'waves' scheduling, contiguous abilities that do not conflict are run together.
+        self.scheduling = scheduling
+        self.independent_abilities = set(independent_abilities or [])
+        self._abilities_by_id = dict()
+        self._agent_states = dict()   # paw -> (group, platform, executors) of the indexed agents
+        self._agent_index_version = 0
+        self._agents_by_group = None
+        self._valid_agents_by_ability = dict()
+        self._eligible_paws_by_ability = dict()
+        self._eligible_agents_by_ability = dict()
         self.log = BaseWorld.create_logger('group_filtered_planner')
 
     async def execute(self):
-        await self.planning_svc.execute_planner(self)
+        try:
+            await self.planning_svc.execute_planner(self)
+        finally:
+            # The planner may stop on a stopping condition while the next links are being prefetched.
+            self._cancel_prefetch()
 
     async def fetch_and_run_links(self):
-        links_to_use = await self._fetch_links()
-        if links_to_use:
-            # Each agent will run the next available step.
-            self.log.debug('Applying %d links', len(links_to_use))
-            links_to_wait_for = [await self.operation.apply(link) for link in links_to_use]
-            await self.operation.wait_for_links_completion(links_to_wait_for)
-        else:
-            self.log.debug('No more links to run.')
-            self.next_bucket = None
+        with emu_metrics.planner_bucket_seconds.time(bucket='fetch_and_run_links'):
+            links_to_use = await self._fetch_links()
+            if links_to_use:
+                # Each agent will run the next available step.
+                self.log.debug('Applying %d links', len(links_to_use))
+                if self.pipelined:
+                    links_to_wait_for = await asyncio.gather(*(self.operation.apply(link) for link in links_to_use))
+                    await self._start_prefetch()
+                else:
+                    links_to_wait_for = [await self.operation.apply(link) for link in links_to_use]
+                await self.operation.wait_for_links_completion(links_to_wait_for)
+            else:
+                self.log.debug('No more links to run.')
+                self.next_bucket = None
 
     async def _fetch_links(self):
         # If we have no pending links, go to the next ability in the adversary profile.
@@ -35,43 +64,252 @@ class LogicalPlanner:
         # If the ability does not generate any runnable links, iterate through the
         # atomic ordering until we find an ability that does generate links.
         while not self.pending_links:
+            await self._refresh_eligible_agents()
+            self._skip_unrunnable_abilities()
             if self.current_ability_index >= len(self.operation.adversary.atomic_ordering):
+                self._cancel_prefetch()
                 return []
-            ability_id = self.operation.adversary.atomic_ordering[self.current_ability_index]
-            self.pending_links = await self._get_pending_links(ability_id)
-            self.current_ability_index += 1
+            if self.scheduling == 'waves':
+                wave = self._get_next_wave()
+                self.log.debug('Running a wave of %d abilities', len(wave))
+            else:
+                wave = [(self.current_ability_index, self.operation.adversary.atomic_ordering[self.current_ability_index])]
+            links_by_ability = await asyncio.gather(*(self._get_ability_links(ability_index, ability_id)
+                                                      for ability_index, ability_id in wave))
+            # Each agent's queue holds the links of the wave's abilities in profile order.
+            self.pending_links = self._queue_links(itertools.chain.from_iterable(links_by_ability))
+            self.current_ability_index += len(wave)
         return self._fetch_from_pending_links()
 
+    async def _get_ability_links(self, ability_index, ability_id):
+        prefetched_links = await self._take_prefetched_links(ability_index)
+        if prefetched_links is None:
+            return await self._get_pending_links(ability_id)
+        return prefetched_links
+
+    def _get_next_wave(self):
+        """Return the (index, ability ID) pairs of the contiguous abilities from the current ability onwards that
+        are independent of each other, either because their valid agents are disjoint or because they are
+        listed in independent_abilities."""
+        atomic_ordering = self.operation.adversary.atomic_ordering
+        wave = []
+        wave_paws = set()
+        for ability_index in range(self.current_ability_index, len(atomic_ordering)):
+            ability_id = atomic_ordering[ability_index]
+            paws = {agent.paw for agent in self._get_candidate_agents(ability_id)}
+            if wave and not self._is_independent(ability_id, paws, wave, wave_paws):
+                break
+            wave.append((ability_index, ability_id))
+            wave_paws.update(paws)
+        return wave
+
+    def _is_independent(self, ability_id, paws, wave, wave_paws):
+        if ability_id in self.independent_abilities and all(a in self.independent_abilities for _, a in wave):
+            return True
+        return wave_paws.isdisjoint(paws)
+
     async def _get_pending_links(self, ability_id):
-        valid_agents = self._get_valid_agents_for_ability(ability_id)
-        potential_links = []
-        for agent in valid_agents:
-            potential_links += await self._get_links(agent=agent)
-        return [link for link in potential_links if link.ability.ability_id == ability_id]
+        valid_agents = self._get_candidate_agents(ability_id)
+        semaphore = asyncio.Semaphore(self.link_generation_concurrency)
+
+        async def _get_agent_links(agent):
+            async with semaphore:
+                return await self._get_links(agent=agent, ability_id=ability_id)
+        # Links are generated concurrently across agents but merged in agent order.
+        links_by_agent = await asyncio.gather(*(_get_agent_links(agent) for agent in valid_agents))
+        potential_links = list(itertools.chain.from_iterable(links_by_agent))
+        pending_links = [link for link in potential_links if link.ability.ability_id == ability_id]
+        emu_metrics.planner_links_generated_total.inc(len(potential_links))
+        emu_metrics.planner_links_discarded_total.inc(len(potential_links) - len(pending_links))
+        return pending_links
+
+    async def _start_prefetch(self):
+        """Once the current ability has been fully dispatched, generate the next ability's links in the background
+        while the agents execute the current links."""
+        if self.pending_links or self.current_ability_index >= len(self.operation.adversary.atomic_ordering):
+            return
+        snapshot = await self._get_prefetch_snapshot()
+        if snapshot is None:
+            return
+        ability_id = self.operation.adversary.atomic_ordering[self.current_ability_index]
+        task = asyncio.get_running_loop().create_task(self._get_pending_links(ability_id))
+        self._prefetch = (self.current_ability_index, snapshot, task)
+
+    async def _take_prefetched_links(self, ability_index):
+        """Return the links prefetched for the ability, or None if there are none or they are out of date because
+        agents or facts changed while the previous links executed."""
+        if not self._prefetch:
+            return None
+        prefetched_index, snapshot, task = self._prefetch
+        self._prefetch = None
+        if prefetched_index != ability_index or await self._get_prefetch_snapshot() != snapshot:
+            self._discard_prefetched_links(prefetched_index, task)
+            return None
+        try:
+            return await task
+        except Exception as e:
+            self.log.debug('Failed to prefetch links for ability #%d: %s', prefetched_index, e)
+            return None
+
+    def _cancel_prefetch(self):
+        """Cancel the links being prefetched, if any, when they will not be used."""
+        if self._prefetch:
+            prefetched_index, _, task = self._prefetch
+            self._prefetch = None
+            self._discard_prefetched_links(prefetched_index, task)
+
+    def _discard_prefetched_links(self, prefetched_index, task):
+        task.cancel()
+        if task.done() and not task.cancelled():
+            if task.exception():
+                self.log.debug('Failed to prefetch links for ability #%d: %s', prefetched_index, task.exception())
+            else:
+                emu_metrics.planner_links_discarded_total.inc(len(task.result()))
+        self.log.debug('Discarding prefetched links for ability #%d', prefetched_index)
+
+    async def _get_prefetch_snapshot(self):
+        """Capture the agent index version and the facts and fact scores that generated links and their order depend
+        on, or None if facts are unavailable. The index is refreshed before prefetched links are taken, so its version
+        changes if agents joined, left or changed in between."""
+        if not hasattr(self.operation, 'all_facts'):
+            return None
+        facts = await self.operation.all_facts()
+        return self._agent_index_version, [(fact.unique, fact.score) for fact in facts]
 
     def _fetch_from_pending_links(self):
         """Return at most one link per agent. Any link that gets assigned will be removed from self.pending_links."""
-        assigned_agent_paws = set()
         links_to_use = []
-        unassigned_links = []
-        for link in self.pending_links:
-            if link.paw not in assigned_agent_paws:
-                assigned_agent_paws.add(link.paw)
-                links_to_use.append(link)
-            else:
-                # Agent has already been assigned a link from this pool
-                unassigned_links.append(link)
-        self.pending_links = unassigned_links
+        for paw, agent_links in list(self.pending_links.items()):
+            links_to_use.append(agent_links.popleft())
+            if not agent_links:
+                del self.pending_links[paw]
         return links_to_use
 
+    @staticmethod
+    def _queue_links(links):
+        """Group links into per-agent queues, keeping the order of the links for each agent."""
+        queued_links = dict()
+        for link in links:
+            queued_links.setdefault(link.paw, deque()).append(link)
+        return queued_links
+
     def _get_valid_agents_for_ability(self, ability_id):
         if ability_id not in self.filtered_groups_by_ability:
             return self.operation.agents
-        valid_agents = []
+        if self._agents_by_group is None:
+            self._refresh_agent_index()
+        if ability_id not in self._valid_agents_by_ability:
+            indexed_agents = []
+            for group in self.filtered_groups_by_ability[ability_id]:
+                indexed_agents.extend(self._agents_by_group.get(group, []))
+            self._valid_agents_by_ability[ability_id] = [agent for _, agent in sorted(indexed_agents,
+                                                                                      key=lambda a: a[0])]
+        return self._valid_agents_by_ability[ability_id]
+
+    def _refresh_agent_index(self):
+        """Update the group to agents index when agents join or leave the operation or change groups, platforms or
+        executors. Return the agents that joined or changed and the paws of the agents that left."""
+        changed_agents = []
         for agent in self.operation.agents:
-            if agent.group in self.filtered_groups_by_ability.get(ability_id, []):
-                valid_agents.append(agent)
-        return valid_agents
+            state = self._agent_states.get(agent.paw)
+            if state is None or state[0] != agent.group or state[1] != agent.platform or state[2] != agent.executors:
+                changed_agents.append(agent)
+        for agent in changed_agents:
+            self._agent_states[agent.paw] = self._get_agent_state(agent)
+        removed_paws = set()
+        if len(self._agent_states) > len(self.operation.agents):
+            removed_paws = self._agent_states.keys() - {agent.paw for agent in self.operation.agents}
+            for paw in removed_paws:
+                del self._agent_states[paw]
+        if changed_agents or removed_paws or self._agents_by_group is None:
+            self._agent_index_version += 1
+            self._agents_by_group = dict()
+            self._valid_agents_by_ability = dict()
+            self._eligible_agents_by_ability = dict()
+            for position, agent in enumerate(self.operation.agents):
+                self._agents_by_group.setdefault(agent.group, []).append((position, agent))
+        return changed_agents, removed_paws
 
-    async def _get_links(self, agent=None):
+    async def _refresh_eligible_agents(self):
+        """Update the table of agents that can run each ability in the adversary profile, based on the group filters
+        and on the platforms and executors of the agents and abilities. This runs each time the planner moves to a
+        new ability, and only the agents that joined the operation or changed since are checked."""
+        changed_agents, removed_paws = self._refresh_agent_index()
+        if self._eligible_paws_by_ability and not changed_agents and not removed_paws:
+            return
+        for ability_id in dict.fromkeys(self.operation.adversary.atomic_ordering):
+            abilities = await self._get_abilities(ability_id)
+            if ability_id not in self._eligible_paws_by_ability:
+                self._eligible_paws_by_ability[ability_id] = set()
+                agents_to_check = self.operation.agents
+            else:
+                agents_to_check = changed_agents
+            eligible_paws = self._eligible_paws_by_ability[ability_id]
+            eligible_paws.difference_update(removed_paws)
+            for agent in agents_to_check:
+                if self._is_eligible(agent, ability_id, abilities):
+                    eligible_paws.add(agent.paw)
+                else:
+                    eligible_paws.discard(agent.paw)
+
+    def _skip_unrunnable_abilities(self):
+        atomic_ordering = self.operation.adversary.atomic_ordering
+        while self.current_ability_index < len(atomic_ordering) \
+                and not self._get_candidate_agents(atomic_ordering[self.current_ability_index]):
+            self.log.debug('No agent can run ability %s. Skipping.', atomic_ordering[self.current_ability_index])
+            emu_metrics.planner_abilities_skipped_total.inc()
+            self.current_ability_index += 1
+
+    def _get_candidate_agents(self, ability_id):
+        if ability_id not in self._eligible_paws_by_ability:
+            return self._get_valid_agents_for_ability(ability_id)
+        if ability_id not in self._eligible_agents_by_ability:
+            # Keep the eligible agents in the order they appear in the operation.
+            eligible_paws = self._eligible_paws_by_ability[ability_id]
+            self._eligible_agents_by_ability[ability_id] = [agent for agent
+                                                            in self._get_valid_agents_for_ability(ability_id)
+                                                            if agent.paw in eligible_paws]
+        return self._eligible_agents_by_ability[ability_id]
+
+    def _is_eligible(self, agent, ability_id, abilities):
+        if ability_id in self.filtered_groups_by_ability \
+                and agent.group not in self.filtered_groups_by_ability[ability_id]:
+            return False
+        if abilities is None:
+            return True
+        platform = agent.platform
+        executors = agent.executors
+        return any(self._can_run(platform, executors, ability) for ability in abilities)
+
+    @staticmethod
+    def _get_agent_state(agent):
+        """Return the agent properties that decide which abilities it can run."""
+        return agent.group, agent.platform, list(agent.executors) if agent.executors is not None else None
+
+    @staticmethod
+    def _can_run(platform, executors, ability):
+        """Return whether an agent with the platform and executors can run the ability. Agents or abilities without
+        this information are assumed to be able to run it, so link generation decides."""
+        ability_executors = getattr(ability, 'executors', None)
+        if platform is None or executors is None or ability_executors is None:
+            return True
+        return any(executor.platform == platform and executor.name in executors for executor in ability_executors)
+
+    async def _get_links(self, agent=None, ability_id=None):
+        """Generate the links for a single ability when the planning service supports it, so that each step does
+        not generate and discard links for every other ability in the adversary profile."""
+        if ability_id is not None and agent is not None and hasattr(self.planning_svc, 'generate_and_trim_links'):
+            abilities = await self._get_abilities(ability_id)
+            if abilities is not None:
+                links = await self.planning_svc.generate_and_trim_links(agent, self.operation, abilities)
+                return await self.planning_svc.sort_links(links)
         return await self.planning_svc.get_links(operation=self.operation, agent=agent)
+
+    async def _get_abilities(self, ability_id):
+        """Return the abilities matching the ID, or None if they cannot be looked up through the data service."""
+        if ability_id not in self._abilities_by_id:
+            data_svc = self.planning_svc.get_service('data_svc') if hasattr(self.planning_svc, 'get_service') else None
+            if not data_svc:
+                return None
+            self._abilities_by_id[ability_id] = await data_svc.locate('abilities', match=dict(ability_id=ability_id))
+        return self._abilities_by_id[ability_id]
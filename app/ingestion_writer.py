@@ -0,0 +1,125 @@
+import asyncio
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from plugins.emu.app import emu_metrics
+
+
+class IngestionWriter:
+    """
+    Queues the files generated during ingestion and writes them from a thread pool in batches,
+    so that file I/O does not block the event loop. Existing files are never overwritten.
+
+    Each target path is always written by the same single-threaded worker, so operations on a path
+    run in queue order even when they land in different batches.
+    """
+
+    def __init__(self, log, max_workers=4, batch_size=64):
+        self.log = log
+        self.max_workers = max(1, max_workers)
+        self.batch_size = max(1, batch_size)
+        self._executors = [ThreadPoolExecutor(max_workers=1, thread_name_prefix='emu_writer_%d' % i)
+                           for i in range(self.max_workers)]
+        self._pending = []
+        self._in_flight = set()
+        self._known_dirs = set()
+
+    def write(self, path, content):
+        """
+        Queue `content` to be written to `path`. Returns a future that resolves to True if the file
+        was written, or False if it already existed.
+        """
+        return self._queue(path, self._write_file, path, content)
+
+    def copy(self, source_path, target_path):
+        """
+        Queue a copy of `source_path` to `target_path`. Returns a future that resolves to True if the
+        file was copied, or False if the target already existed.
+        """
+        return self._queue(target_path, self._copy_file, source_path, target_path)
+
+    async def flush(self):
+        """Write everything queued so far and wait for all in-flight batches to complete."""
+        if self._pending:
+            self._start_batch()
+        while self._in_flight:
+            await asyncio.gather(*self._in_flight)
+
+    def shutdown(self):
+        for executor in self._executors:
+            executor.shutdown(wait=False)
+
+    """ PRIVATE """
+
+    def _queue(self, target_path, func, *args):
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(self._log_result)
+        self._pending.append((future, target_path, func, args))
+        if len(self._pending) >= self.batch_size:
+            self._start_batch()
+        return future
+
+    def _start_batch(self):
+        batch, self._pending = self._pending, []
+        # Operations on the same target path always go to the same worker, and chunks are submitted
+        # synchronously in batch order, so they run in queue order across batches.
+        chunks = [[] for _ in range(self.max_workers)]
+        for operation in batch:
+            chunks[hash(operation[1]) % self.max_workers].append(operation)
+        loop = asyncio.get_running_loop()
+        submitted = [(chunk, loop.run_in_executor(executor, self._run_operations, [op[2:] for op in chunk]))
+                     for executor, chunk in zip(self._executors, chunks) if chunk]
+        task = loop.create_task(self._write_batch(submitted, time.perf_counter()))
+        self._in_flight.add(task)
+        task.add_done_callback(self._in_flight.discard)
+
+    @staticmethod
+    async def _write_batch(submitted, started):
+        results = await asyncio.gather(*(future for _, future in submitted))
+        # Batches mix the ability, adversary, source and planner files generated by ingestion.
+        emu_metrics.ingestion_phase_seconds.observe(time.perf_counter() - started, phase='file_write')
+        for (chunk, _), chunk_results in zip(submitted, results):
+            for (future, _, _, _), (result, error) in zip(chunk, chunk_results):
+                if error:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+
+    @staticmethod
+    def _run_operations(operations):
+        results = []
+        for func, args in operations:
+            try:
+                results.append((func(*args), None))
+            except Exception as e:
+                results.append((None, e))
+        return results
+
+    def _ensure_dir(self, directory):
+        if directory not in self._known_dirs:
+            os.makedirs(directory, exist_ok=True)
+            self._known_dirs.add(directory)
+
+    def _write_file(self, path, content):
+        self._ensure_dir(os.path.dirname(path))
+        try:
+            with open(path, 'x') as f:
+                f.write(content)
+        except FileExistsError:
+            self.log.debug('File %s already exists. Skipping.', path)
+            return False
+        return True
+
+    def _copy_file(self, source_path, target_path):
+        self._ensure_dir(os.path.dirname(target_path))
+        if os.path.exists(target_path):
+            self.log.debug('File %s already exists. Skipping.', target_path)
+            return False
+        shutil.copyfile(source_path, target_path)
+        return True
+
+    def _log_result(self, future):
+        if not future.cancelled() and future.exception():
+            self.log.error('Failed to write ingested file: %s', future.exception())
@@ -18,8 +18,9 @@ async def enable(services):
     app = services.get('app_svc').application
     app.router.add_route('GET', '/plugin/emu/gui', emu_gui.splash)
 
-    if not os.path.isdir(plugin_svc.repo_dir):
-        await plugin_svc.clone_repo()
-
-    await plugin_svc.decrypt_payloads()
-    await plugin_svc.populate_data_directory()
+    if plugin_svc.snapshot_path and await plugin_svc.install_snapshot(plugin_svc.snapshot_path):
+        return
+    if plugin_svc.background_ingestion:
+        plugin_svc.start_background_ingestion()
+    else:
+        await plugin_svc.ingest()
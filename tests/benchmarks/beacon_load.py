@@ -0,0 +1,176 @@
+"""
+Load test the emu forwarded beacon endpoints against a stand-in contact_svc with configurable latency.
+
+Run from the Caldera root directory:
+
+    python -m plugins.emu.tests.benchmarks.beacon_load --requests 20000 --concurrency 64 --latency-ms 2
+
+The report includes throughput, p50/p95/p99 request latency and response status counts for the settings used.
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from aiohttp import ClientSession, web
+from aiohttp.test_utils import TestServer
+
+from plugins.emu.app.emu_svc import EmuService
+from plugins.emu.tests.benchmarks.report import add_output_argument, write_report
+
+
+class StubContactService:
+    """Stands in for Caldera's contact_svc, taking `latency` seconds per heartbeat."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.heartbeats = 0
+
+    async def handle_heartbeat(self, **kwargs):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.heartbeats += 1
+        return None, []
+
+
+def create_app(emu_svc):
+    app = web.Application()
+    app.router.add_route('POST', '/plugins/emu/beacons', emu_svc.handle_forwarded_beacon)
+    app.router.add_route('POST', '/plugins/emu/beacons/bulk', emu_svc.handle_forwarded_beacons)
+    app.router.add_route('GET', '/plugins/emu/beacons/ws', emu_svc.handle_beacon_stream)
+    return app
+
+
+def generate_beacons(count, sessions, malformed_ratio, seed=0):
+    """Generate `count` beacon bodies spread over `sessions` sessions, with a share of malformed payloads."""
+    rng = random.Random(seed)
+    beacons = []
+    for _ in range(count):
+        if rng.random() < malformed_ratio:
+            beacons.append(rng.choice(['{"guid": ', '{"hostName": "host"}', '{"guid": "x", "pid": "abc"}']))
+            continue
+        session = rng.randrange(sessions)
+        beacons.append(json.dumps(dict(guid='session-%d' % session, hostName='host-%d' % session,
+                                       user='user-%d' % session, pid=1000 + session, ppid=1)))
+    return beacons
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(round(pct / 100.0 * (len(sorted_values) - 1))))]
+
+
+async def _drive_http(session, url, bodies, concurrency, headers=None):
+    latencies, statuses = [], dict()
+    iterator = iter(bodies)
+
+    async def _client():
+        for body in iterator:
+            start = time.perf_counter()
+            async with session.post(url, data=body, headers=headers) as resp:
+                await resp.read()
+                statuses[resp.status] = statuses.get(resp.status, 0) + 1
+            latencies.append(time.perf_counter() - start)
+    await asyncio.gather(*(_client() for _ in range(concurrency)))
+    return latencies, statuses
+
+
+async def _drive_stream(session, url, beacons, concurrency):
+    latencies, statuses = [], dict()
+    chunks = [beacons[i::concurrency] for i in range(concurrency)]
+
+    async def _connection(chunk):
+        async with session.ws_connect(url) as ws:
+            sent = dict()
+            for index, beacon in enumerate(chunk):
+                sent[index] = time.perf_counter()
+                await ws.send_str(beacon)
+            for _ in chunk:
+                ack = await ws.receive_json()
+                latencies.append(time.perf_counter() - sent[ack['index']])
+                statuses[ack['status']] = statuses.get(ack['status'], 0) + 1
+    await asyncio.gather(*(_connection(chunk) for chunk in chunks if chunk))
+    return latencies, statuses
+
+
+async def run_load_test(requests=10000, concurrency=32, latency=0.0, sessions=100, malformed_ratio=0.0,
+                        mode='single', batch_size=100, settings=None):
+    """
+    Send `requests` beacons through the given `mode` ('single', 'bulk' or 'stream') using `concurrency`
+    clients or connections, and return throughput and latency statistics.
+    """
+    emu_svc = EmuService()
+    emu_svc.contact_svc = StubContactService(latency)
+    for name, value in (settings or dict()).items():
+        setattr(emu_svc, name, value)
+    beacons = generate_beacons(requests, sessions, malformed_ratio)
+
+    server = TestServer(create_app(emu_svc))
+    await server.start_server()
+    try:
+        async with ClientSession() as session:
+            start = time.perf_counter()
+            if mode == 'single':
+                latencies, statuses = await _drive_http(session, server.make_url('/plugins/emu/beacons'),
+                                                        beacons, concurrency)
+            elif mode == 'bulk':
+                batches = ['\n'.join(beacons[i:i + batch_size]) for i in range(0, len(beacons), batch_size)]
+                latencies, statuses = await _drive_http(session, server.make_url('/plugins/emu/beacons/bulk'),
+                                                        batches, concurrency,
+                                                        headers={'Content-Type': 'application/x-ndjson'})
+            elif mode == 'stream':
+                latencies, statuses = await _drive_stream(session, server.make_url('/plugins/emu/beacons/ws'),
+                                                          beacons, concurrency)
+            else:
+                raise ValueError('unknown mode %s' % mode)
+            elapsed = time.perf_counter() - start
+            if emu_svc.beacon_queue is not None:
+                await emu_svc.beacon_queue.join()
+            drained = time.perf_counter() - start
+    finally:
+        for worker in emu_svc._beacon_workers:
+            worker.cancel()
+        await server.close()
+
+    latencies.sort()
+    return dict(
+        mode=mode, beacons=requests, requests=len(latencies), elapsed=elapsed, drained=drained,
+        beacons_per_second=requests / elapsed if elapsed else None,
+        requests_per_second=len(latencies) / elapsed if elapsed else None,
+        latency=dict(p50=percentile(latencies, 50), p95=percentile(latencies, 95), p99=percentile(latencies, 99),
+                     max=latencies[-1] if latencies else None),
+        statuses={str(status): count for status, count in statuses.items()},
+        heartbeats=emu_svc.contact_svc.heartbeats,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the emu forwarded beacon endpoints.')
+    parser.add_argument('--requests', type=int, default=10000, help='number of beacons to send')
+    parser.add_argument('--concurrency', type=int, default=32, help='concurrent clients or stream connections')
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='stub handle_heartbeat latency')
+    parser.add_argument('--sessions', type=int, default=100, help='number of distinct beacon sessions')
+    parser.add_argument('--malformed-ratio', type=float, default=0.0, help='share of malformed beacons')
+    parser.add_argument('--mode', choices=('single', 'bulk', 'stream'), default='single')
+    parser.add_argument('--batch-size', type=int, default=100, help='beacons per bulk request')
+    parser.add_argument('--queue', action='store_true', help='enable the beacon queue')
+    parser.add_argument('--beacon-workers', type=int, default=8)
+    parser.add_argument('--coalesce-window', type=float, default=0.0)
+    add_output_argument(parser)
+    args = parser.parse_args()
+
+    settings = dict(beacon_queue_enabled=args.queue, beacon_workers=args.beacon_workers,
+                    beacon_queue_size=max(args.requests, 1), beacon_coalesce_window=args.coalesce_window)
+    results = asyncio.run(run_load_test(requests=args.requests, concurrency=args.concurrency,
+                                        latency=args.latency_ms / 1000.0, sessions=args.sessions,
+                                        malformed_ratio=args.malformed_ratio, mode=args.mode,
+                                        batch_size=args.batch_size, settings=settings))
+    results.update(settings=settings, latency_ms=args.latency_ms, concurrency=args.concurrency,
+                   sessions=args.sessions, malformed_ratio=args.malformed_ratio)
+    write_report('beacon_load', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
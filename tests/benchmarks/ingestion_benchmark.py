@@ -0,0 +1,112 @@
+"""
+Benchmark the emu ingestion startup path against a synthetic Adversary Emulation Library.
+
+Run from the Caldera root directory:
+
+    python -m plugins.emu.tests.benchmarks.ingestion_benchmark --plans 50 --abilities 100 --output ingestion.json
+
+Each run times decrypt_payloads, plan ingestion, _store_required_payloads and planner ingestion separately.
+A cold run starts from empty data and payload directories, and a warm run repeats startup against the
+generated output, as a Caldera restart would.
+"""
+import argparse
+import asyncio
+import functools
+import os
+import tempfile
+import time
+
+from plugins.emu.app.emu_svc import EmuService
+from plugins.emu.tests.benchmarks.report import add_output_argument, write_report
+from plugins.emu.tests.benchmarks.synthetic_library import SyntheticLibrary
+
+
+class PhaseTimer:
+    def __init__(self):
+        self.phases = dict()
+
+    def wrap(self, name, func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def _timed(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    self._add(name, time.perf_counter() - start)
+        else:
+            @functools.wraps(func)
+            def _timed(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self._add(name, time.perf_counter() - start)
+        return _timed
+
+    def _add(self, name, elapsed):
+        self.phases[name] = self.phases.get(name, 0) + elapsed
+
+
+async def time_startup(library_dir, output_dir, **settings):
+    """Run one emu startup against `library_dir`, writing into `output_dir`, and return per-phase timings."""
+    emu_svc = EmuService()
+    emu_svc.repo_dir = library_dir
+    emu_svc.data_dir = os.path.join(output_dir, 'data')
+    emu_svc.payloads_dir = os.path.join(output_dir, 'payloads')
+    emu_svc.manifest_path = os.path.join(emu_svc.data_dir, 'ingestion_manifest.json')
+    emu_svc.decryption_record_path = os.path.join(emu_svc.data_dir, 'decryption_manifest.json')
+    os.makedirs(emu_svc.payloads_dir, exist_ok=True)
+    for name, value in settings.items():
+        setattr(emu_svc, name, value)
+
+    timer = PhaseTimer()
+    emu_svc.decrypt_payloads = timer.wrap('decrypt_payloads', emu_svc.decrypt_payloads)
+    emu_svc._load_adversaries_and_abilities = timer.wrap('load_plans', emu_svc._load_adversaries_and_abilities)
+    emu_svc._store_required_payloads = timer.wrap('store_required_payloads', emu_svc._store_required_payloads)
+    emu_svc._load_planners = timer.wrap('load_planners', emu_svc._load_planners)
+
+    start = time.perf_counter()
+    await emu_svc.decrypt_payloads()
+    await emu_svc.populate_data_directory(library_path=os.path.join(library_dir, '*'))
+    total = time.perf_counter() - start
+    emu_svc.writer.shutdown()
+
+    phases = dict(timer.phases)
+    phases['load_plans'] = phases.get('load_plans', 0) - phases.get('store_required_payloads', 0)
+    return dict(total=total, phases=phases, payload_lookups=emu_svc.payload_lookup_stats,
+                progress=emu_svc.ingestion_status['progress'])
+
+
+async def run_benchmark(library_args, settings=None):
+    settings = settings or dict()
+    results = dict(library=None, settings=settings, runs=dict())
+    with SyntheticLibrary(**library_args) as library, tempfile.TemporaryDirectory() as output_dir:
+        results['library'] = library.summary
+        results['runs']['cold'] = await time_startup(library.library_dir, output_dir, **settings)
+        results['runs']['warm'] = await time_startup(library.library_dir, output_dir, **settings)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark emu ingestion against a synthetic emulation library.')
+    parser.add_argument('--plans', type=int, default=10)
+    parser.add_argument('--abilities', type=int, default=50, help='abilities per plan')
+    parser.add_argument('--platforms', type=int, default=2, help='platforms per ability (max 3)')
+    parser.add_argument('--payloads', type=int, default=5, help='payloads per plan')
+    parser.add_argument('--encrypted-payloads', type=int, default=2, help='encrypted payloads per plan')
+    parser.add_argument('--payload-size', type=int, default=4096, help='payload size in bytes')
+    parser.add_argument('--ingestion-workers', type=int, default=0)
+    parser.add_argument('--no-incremental', action='store_true', help='disable the ingestion manifest')
+    add_output_argument(parser)
+    args = parser.parse_args()
+
+    library_args = dict(plans=args.plans, abilities=args.abilities, platforms=args.platforms, payloads=args.payloads,
+                        encrypted_payloads=args.encrypted_payloads, payload_size=args.payload_size)
+    settings = dict(ingestion_workers=args.ingestion_workers, incremental_ingestion=not args.no_incremental)
+    results = asyncio.run(run_benchmark(library_args, settings))
+    write_report('ingestion', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+"""
+Benchmark the group filtered planner against a simulated operation with stub agents and a stub planning service.
+
+Run from the Caldera root directory:
+
+    python -m plugins.emu.tests.benchmarks.planner_benchmark --agents 2000 --groups 20 --abilities 100 --facts 5
+
+The report includes the time spent in each planner bucket, the number of links generated and used, the number of
+link generation calls and the peak memory traced during the run, for the settings and planner parameters used.
+"""
+import argparse
+import asyncio
+import random
+import time
+import tracemalloc
+
+from plugins.emu.app.group_filtered_planner import LogicalPlanner
+from plugins.emu.tests.benchmarks.report import add_output_argument, write_report
+
+PLATFORMS = (('windows', 'psh'), ('linux', 'sh'), ('darwin', 'sh'))
+
+
+class StubAgent:
+    def __init__(self, paw, group, platform, executors):
+        self.paw = paw
+        self.group = group
+        self.platform = platform
+        self.executors = executors
+        self.trusted = True
+
+
+class StubExecutor:
+    def __init__(self, platform, name):
+        self.platform = platform
+        self.name = name
+
+
+class StubAbility:
+    def __init__(self, ability_id, executors):
+        self.ability_id = ability_id
+        self.executors = executors
+
+
+class StubLink:
+    def __init__(self, paw, ability, command):
+        self.paw = paw
+        self.ability = ability
+        self.command = command
+        self.score = 0
+
+
+class StubAdversary:
+    def __init__(self, atomic_ordering):
+        self.atomic_ordering = atomic_ordering
+
+
+class StubOperation:
+    """Stands in for a Caldera operation whose links take `link_latency` seconds to complete."""
+
+    def __init__(self, adversary, agents, link_latency=0.0):
+        self.adversary = adversary
+        self.agents = agents
+        self.link_latency = link_latency
+        self.links_used = 0
+        self.facts = []
+
+    async def apply(self, link):
+        self.links_used += 1
+        return link
+
+    async def wait_for_links_completion(self, links):
+        if self.link_latency:
+            await asyncio.sleep(self.link_latency)
+
+    async def all_facts(self):
+        return self.facts
+
+
+class StubDataService:
+    def __init__(self, abilities):
+        self.abilities = {ability.ability_id: ability for ability in abilities}
+
+    async def locate(self, object_name, match):
+        ability = self.abilities.get(match['ability_id'])
+        return [ability] if ability else []
+
+
+class StubProfilePlanningService:
+    """
+    Stands in for a planning_svc that can only generate links for the whole adversary profile at once. Each
+    ability generates `facts` links per agent that can run it, one per fact combination, and each link
+    generation call takes `generation_latency` seconds.
+    """
+
+    def __init__(self, abilities, facts=1, generation_latency=0.0):
+        self.data_svc = StubDataService(abilities)
+        self.facts = facts
+        self.generation_latency = generation_latency
+        self.generation_calls = 0
+        self.links_generated = 0
+
+    def get_service(self, name):
+        return self.data_svc if name == 'data_svc' else None
+
+    async def get_links(self, operation, agent=None):
+        abilities = [self.data_svc.abilities[a] for a in dict.fromkeys(operation.adversary.atomic_ordering)]
+        return await self.sort_links(await self._generate_links(agent, abilities))
+
+    @staticmethod
+    async def sort_links(links):
+        return sorted(links, key=lambda link: -link.score)
+
+    async def _generate_links(self, agent, abilities):
+        self.generation_calls += 1
+        if self.generation_latency:
+            await asyncio.sleep(self.generation_latency)
+        links = [StubLink(agent.paw, ability, '%s-%d' % (ability.ability_id, fact))
+                 for ability in abilities
+                 if any(e.platform == agent.platform and e.name in agent.executors for e in ability.executors)
+                 for fact in range(self.facts)]
+        self.links_generated += len(links)
+        return links
+
+
+class StubPlanningService(StubProfilePlanningService):
+    """Stands in for Caldera's planning_svc, which can generate the links for specific abilities."""
+
+    async def generate_and_trim_links(self, agent, operation, abilities, trim=True):
+        return await self._generate_links(agent, abilities)
+
+
+def generate_scenario(agents=100, groups=4, abilities=20, filtered_ratio=0.5, seed=0):
+    """
+    Generate agents spread over `groups` groups and platforms, and an adversary profile of `abilities` abilities,
+    a share of which is restricted to a single group through filtered_groups_by_ability.
+    """
+    rng = random.Random(seed)
+    stub_agents = []
+    for i in range(agents):
+        agent_platform, executor = PLATFORMS[i % len(PLATFORMS)]
+        stub_agents.append(StubAgent('paw-%d' % i, 'group-%d' % (i % groups), agent_platform, [executor]))
+    stub_abilities = []
+    for i in range(abilities):
+        ability_platform, executor = PLATFORMS[rng.randrange(len(PLATFORMS))]
+        stub_abilities.append(StubAbility('ability-%d' % i, [StubExecutor(ability_platform, executor)]))
+    filtered_groups_by_ability = {ability.ability_id: ['group-%d' % rng.randrange(groups)]
+                                  for ability in stub_abilities if rng.random() < filtered_ratio}
+    return stub_agents, stub_abilities, filtered_groups_by_ability
+
+
+async def run_benchmark(agents=100, groups=4, abilities=20, filtered_ratio=0.5, facts=1, link_latency=0.0,
+                        generation_latency=0.0, profile_links=False, planner_params=None):
+    """Run the planner to completion over a generated scenario and return timing, link and memory statistics."""
+    stub_agents, stub_abilities, filtered_groups_by_ability = generate_scenario(agents, groups, abilities,
+                                                                                filtered_ratio)
+    planning_svc_class = StubProfilePlanningService if profile_links else StubPlanningService
+    planning_svc = planning_svc_class(stub_abilities, facts=facts, generation_latency=generation_latency)
+    operation = StubOperation(StubAdversary([ability.ability_id for ability in stub_abilities]), stub_agents,
+                              link_latency=link_latency)
+
+    tracemalloc.start()
+    try:
+        start = time.perf_counter()
+        planner = LogicalPlanner(operation, planning_svc, filtered_groups_by_ability=filtered_groups_by_ability,
+                                 **(planner_params or dict()))
+        buckets = dict()
+        while planner.next_bucket:
+            bucket = planner.next_bucket
+            bucket_start = time.perf_counter()
+            await getattr(planner, bucket)()
+            buckets.setdefault(bucket, []).append(time.perf_counter() - bucket_start)
+        elapsed = time.perf_counter() - start
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return dict(
+        elapsed=elapsed,
+        buckets={name: dict(count=len(times), total=sum(times), mean=sum(times) / len(times), max=max(times))
+                 for name, times in buckets.items()},
+        links=dict(generated=planning_svc.links_generated, used=operation.links_used),
+        generation_calls=planning_svc.generation_calls,
+        peak_memory_bytes=peak_memory,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the group filtered planner against stub agents.')
+    parser.add_argument('--agents', type=int, default=100, help='number of stub agents')
+    parser.add_argument('--groups', type=int, default=4, help='number of agent groups')
+    parser.add_argument('--abilities', type=int, default=20, help='number of abilities in the adversary profile')
+    parser.add_argument('--filtered-ratio', type=float, default=0.5,
+                        help='share of abilities restricted to a single group')
+    parser.add_argument('--facts', type=int, default=1, help='links generated per ability and agent')
+    parser.add_argument('--link-latency-ms', type=float, default=0.0, help='time for each batch of links to complete')
+    parser.add_argument('--generation-latency-ms', type=float, default=0.0, help='time per link generation call')
+    parser.add_argument('--profile-links', action='store_true',
+                        help='only offer get_links for the whole profile, as older planning services do')
+    parser.add_argument('--link-generation-concurrency', type=int, default=8)
+    parser.add_argument('--pipelined', action='store_true')
+    parser.add_argument('--scheduling', choices=('sequential', 'waves'), default='sequential')
+    add_output_argument(parser)
+    args = parser.parse_args()
+
+    planner_params = dict(link_generation_concurrency=args.link_generation_concurrency, pipelined=args.pipelined,
+                          scheduling=args.scheduling)
+    settings = dict(agents=args.agents, groups=args.groups, abilities=args.abilities,
+                    filtered_ratio=args.filtered_ratio, facts=args.facts, link_latency=args.link_latency_ms / 1000.0,
+                    generation_latency=args.generation_latency_ms / 1000.0, profile_links=args.profile_links)
+    results = asyncio.run(run_benchmark(planner_params=planner_params, **settings))
+    results.update(settings=settings, planner_params=planner_params)
+    write_report('planner', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
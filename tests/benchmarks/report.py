@@ -0,0 +1,35 @@
+"""Helpers shared by the emu benchmarks to stamp results with the revision and host they ran on, and write them."""
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+
+def get_revision():
+    try:
+        return subprocess.check_output(['git', '-C', os.path.dirname(__file__), 'rev-parse', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_run_metadata():
+    return dict(revision=get_revision(), python=sys.version.split()[0], machine=platform.machine(),
+                cpus=os.cpu_count(), timestamp=time.time())
+
+
+def add_output_argument(parser):
+    parser.add_argument('--output', help='write JSON results to this file instead of stdout')
+
+
+def write_report(benchmark, results, output=None):
+    """Add the benchmark name and run metadata to `results`, and write them as JSON to `output` or stdout."""
+    results.update(benchmark=benchmark, **get_run_metadata())
+    report = json.dumps(results, indent=2, sort_keys=True)
+    if output:
+        with open(output, 'w') as f:
+            f.write(report)
+    else:
+        print(report)
@@ -0,0 +1,108 @@
+"""
+Generate a synthetic Adversary Emulation Library with the same layout as the CTID library, for
+benchmarking emu ingestion.
+"""
+import os
+import shutil
+import tempfile
+
+import yaml
+
+PLATFORMS = (('windows', 'psh'), ('linux', 'sh'), ('darwin', 'sh'))
+PAYLOAD_PASSWORD = 'malware'
+
+CRYPT_SCRIPT = '''
+import argparse
+import os
+
+import pyminizip
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-i', dest='input_dir')
+parser.add_argument('-p', dest='password')
+parser.add_argument('--decrypt', action='store_true')
+args = parser.parse_args()
+for root, _, files in os.walk(args.input_dir):
+    for name in files:
+        if name.endswith('.zip'):
+            pyminizip.uncompress(os.path.join(root, name), args.password, root, 0)
+            print('[+] Decrypted %s' % os.path.join(root, name))
+'''
+
+
+def generate_library(root, plans=10, abilities=50, platforms=2, payloads=5, encrypted_payloads=2, payload_size=4096):
+    """
+    Write a synthetic library to `root` with `plans` emulation plans of `abilities` abilities each. Every
+    ability runs on `platforms` platforms, each plan references `payloads` payload files stored under
+    its Resources directory, and `encrypted_payloads` of them are only available inside password
+    protected archives (requires pyminizip). Returns a summary of what was generated.
+    """
+    try:
+        import pyminizip
+    except ImportError:
+        pyminizip = None
+        encrypted_payloads = 0
+    platforms = PLATFORMS[:max(1, min(platforms, len(PLATFORMS)))]
+    for plan_num in range(plans):
+        plan_dir = os.path.join(root, 'plan%d' % plan_num)
+        yaml_dir = os.path.join(plan_dir, 'Emulation_Plan', 'yaml')
+        payload_dir = os.path.join(plan_dir, 'Resources', 'payloads')
+        os.makedirs(os.path.join(yaml_dir, 'planners'))
+        os.makedirs(payload_dir)
+        payload_names = ['payload_%d_%d.bin' % (plan_num, i) for i in range(payloads)]
+        plan = [dict(emulation_plan_details=dict(id='synthetic-plan-%d' % plan_num,
+                                                 adversary_name='Synthetic Adversary %d' % plan_num,
+                                                 adversary_description='Synthetic adversary %d' % plan_num,
+                                                 attack_version=8, format_version=1.0))]
+        for ability_num in range(abilities):
+            ability_payloads = [payload_names[ability_num % payloads]] if payloads else []
+            plan.append(dict(
+                id='synthetic-%d-%d' % (plan_num, ability_num),
+                name='Synthetic ability %d-%d' % (plan_num, ability_num),
+                description='Synthetic ability',
+                tactic='Tactic %d' % (ability_num % 10),
+                technique=dict(attack_id='T%04d' % ability_num, name='Technique %d' % ability_num),
+                platforms={platform: {executor: dict(command='run #{arg%d}' % ability_num, payloads=ability_payloads)}
+                           for platform, executor in platforms},
+                input_arguments={'arg%d' % ability_num: dict(description='argument', type='string',
+                                                             default='value%d' % ability_num)},
+            ))
+        with open(os.path.join(yaml_dir, 'plan%d.yaml' % plan_num), 'w') as f:
+            yaml.dump(plan, f)
+        with open(os.path.join(yaml_dir, 'planners', 'planner%d.yml' % plan_num), 'w') as f:
+            yaml.dump(dict(id='synthetic-planner-%d' % plan_num, name='Synthetic planner', description='',
+                           module='plugins.emu.app.group_filtered_planner', params=dict()), f)
+        for i, payload_name in enumerate(payload_names):
+            payload_path = os.path.join(payload_dir, payload_name)
+            with open(payload_path, 'wb') as f:
+                f.write(os.urandom(payload_size))
+            if i < encrypted_payloads:
+                pyminizip.compress(payload_path, None, '%s.zip' % payload_path, PAYLOAD_PASSWORD, 5)
+                os.remove(payload_path)
+        if pyminizip:
+            os.makedirs(os.path.join(plan_dir, 'Resources', 'utilities'))
+            with open(os.path.join(plan_dir, 'Resources', 'utilities', 'crypt_executables.py'), 'w') as f:
+                f.write(CRYPT_SCRIPT)
+    return dict(plans=plans, abilities=plans * abilities, platforms=len(platforms), payloads=plans * payloads,
+                encrypted_payloads=plans * encrypted_payloads)
+
+
+class SyntheticLibrary:
+    """Context manager that generates a synthetic library in a temporary directory."""
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.root = None
+        self.summary = None
+
+    def __enter__(self):
+        self.root = tempfile.mkdtemp(prefix='emu_library_')
+        self.summary = generate_library(os.path.join(self.root, 'library'), **self.kwargs)
+        return self
+
+    def __exit__(self, *args):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    @property
+    def library_dir(self):
+        return os.path.join(self.root, 'library')
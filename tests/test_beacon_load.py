@@ -0,0 +1,16 @@
+import pytest
+
+from plugins.emu.tests.benchmarks.beacon_load import generate_beacons, run_load_test
+
+
+class TestBeaconLoad:
+    @pytest.mark.parametrize('mode', ['single', 'bulk', 'stream'])
+    async def test_run_load_test(self, mode):
+        valid_beacons = sum(1 for beacon in generate_beacons(50, 5, 0.2) if 'session-' in beacon)
+        results = await run_load_test(requests=50, concurrency=4, sessions=5, malformed_ratio=0.2, mode=mode,
+                                      batch_size=10)
+        assert 0 < valid_beacons < 50
+        assert results['beacons'] == 50
+        assert results['requests'] == (5 if mode == 'bulk' else 50)
+        assert results['heartbeats'] == valid_beacons
+        assert results['latency']['p50'] <= results['latency']['p99']
@@ -0,0 +1,217 @@
+import asyncio
+import json
+
+import pytest
+
+from datetime import datetime, timezone
+from aiohttp import web
+from unittest.mock import AsyncMock
+
+from plugins.emu.app import emu_metrics
+from plugins.emu.app.emu_svc import EmuService
+
+
+class DummyAgent:
+    def __init__(self):
+        self.last_seen = None
+
+
+class StubContactService:
+    def __init__(self):
+        self.handle_heartbeat = AsyncMock(side_effect=self._handle_heartbeat)
+        self.heartbeats = []
+
+    async def _handle_heartbeat(self, **kwargs):
+        if kwargs['paw'] == 'fail':
+            raise RuntimeError('heartbeat failed')
+        self.heartbeats.append(kwargs)
+        return None, []
+
+
+@pytest.fixture
+async def emu_svc():
+    emu_svc = EmuService()
+    emu_svc.contact_svc = StubContactService()
+    yield emu_svc
+    for worker in emu_svc._beacon_workers:
+        worker.cancel()
+
+
+@pytest.fixture
+def beacon_client(emu_svc, aiohttp_client):
+    app = web.Application()
+    app.router.add_route('POST', '/plugins/emu/beacons', emu_svc.handle_forwarded_beacon)
+    app.router.add_route('POST', '/plugins/emu/beacons/bulk', emu_svc.handle_forwarded_beacons)
+    app.router.add_route('GET', '/plugins/emu/metrics', emu_svc.handle_metrics)
+    return aiohttp_client(app)
+
+
+class TestEmuBeacons:
+    async def test_forwarded_beacon(self, emu_svc, beacon_client):
+        client = await beacon_client
+        resp = await client.post('/plugins/emu/beacons', data=json.dumps(dict(guid='abc', hostName='host1', pid=10)))
+        assert resp.status == 200
+        assert emu_svc.contact_svc.heartbeats == [
+            dict(paw='abc', contact='http', group='evals', platform='evals', host='host1', pid=10)
+        ]
+
+    async def test_bulk_beacons_json_array(self, emu_svc, beacon_client):
+        client = await beacon_client
+        beacons = [dict(guid='abc', user='user1', ppid=1), dict(guid='fail'), 'not a beacon',
+                   dict(guid='def', platform='windows')]
+        resp = await client.post('/plugins/emu/beacons/bulk', data=json.dumps(beacons))
+        body = await resp.json()
+        assert resp.status == 200
+        assert body['processed'] == 2 and body['failed'] == 2
+        assert [result['status'] for result in body['results']] == ['ok', 'error', 'error', 'ok']
+        assert body['results'][1]['error'] == 'heartbeat failed'
+        assert sorted(heartbeat['paw'] for heartbeat in emu_svc.contact_svc.heartbeats) == ['abc', 'def']
+        assert dict(paw='abc', contact='http', group='evals', platform='evals', username='user1',
+                    ppid=1) in emu_svc.contact_svc.heartbeats
+
+    async def test_beacon_metrics(self, emu_svc, beacon_client):
+        client = await beacon_client
+        ok = emu_metrics.beacons_total.get(endpoint='bulk', status='ok')
+        errors = emu_metrics.beacons_total.get(endpoint='bulk', status='error')
+        heartbeats = emu_metrics.beacon_heartbeat_seconds.get()['count']
+        await client.post('/plugins/emu/beacons/bulk', data=json.dumps([dict(guid='abc'), dict(guid='fail')]))
+        assert emu_metrics.beacons_total.get(endpoint='bulk', status='ok') == ok + 1
+        assert emu_metrics.beacons_total.get(endpoint='bulk', status='error') == errors + 1
+        assert emu_metrics.beacon_heartbeat_seconds.get()['count'] == heartbeats + 2
+        resp = await client.get('/plugins/emu/metrics')
+        assert resp.status == 200
+        assert resp.headers['Content-Type'].startswith('text/plain')
+        text = await resp.text()
+        assert '# TYPE emu_beacons_total counter' in text
+        assert 'emu_beacon_request_seconds_count{endpoint="bulk"}' in text
+
+    async def test_bulk_beacon_errors_are_timed(self, emu_svc, beacon_client):
+        client = await beacon_client
+        requests = emu_metrics.beacon_request_seconds.get(endpoint='bulk')['count']
+        resp = await client.post('/plugins/emu/beacons/bulk', data='[{"guid": ')
+        assert resp.status == 400
+        assert emu_metrics.beacon_request_seconds.get(endpoint='bulk')['count'] == requests + 1
+
+    async def test_bulk_beacons_ndjson(self, emu_svc, beacon_client):
+        client = await beacon_client
+        body = '\n'.join([json.dumps(dict(guid='abc')), '{not json', '', json.dumps(dict(guid='def'))])
+        resp = await client.post('/plugins/emu/beacons/bulk', data=body,
+                                 headers={'Content-Type': 'application/x-ndjson'})
+        results = (await resp.json())['results']
+        assert [(result['index'], result['status']) for result in results] == [(0, 'ok'), (1, 'error'), (2, 'ok')]
+        assert results[1]['error'].startswith('invalid JSON')
+
+    async def test_bulk_beacons_rejects_malformed_array(self, emu_svc, beacon_client):
+        client = await beacon_client
+        resp = await client.post('/plugins/emu/beacons/bulk', data='[{"guid": "abc"')
+        assert resp.status == 400
+        emu_svc.contact_svc.handle_heartbeat.assert_not_called()
+
+    async def test_queued_beacons_are_drained_by_workers(self, emu_svc, beacon_client):
+        client = await beacon_client
+        emu_svc.beacon_queue_enabled = True
+        emu_svc.beacon_workers = 2
+        for guid in ('abc', 'def', 'fail'):
+            resp = await client.post('/plugins/emu/beacons', data=json.dumps(dict(guid=guid)))
+            assert resp.status == 202
+        await emu_svc.beacon_queue.join()
+        assert sorted(heartbeat['paw'] for heartbeat in emu_svc.contact_svc.heartbeats) == ['abc', 'def']
+        assert len(emu_svc._beacon_workers) == 2
+
+    async def test_full_beacon_queue_rejects_beacons(self, emu_svc, beacon_client):
+        client = await beacon_client
+        emu_svc.beacon_queue_enabled = True
+        emu_svc.beacon_queue_size = 1
+        emu_svc.beacon_workers = 1
+        emu_svc.beacon_retry_after = 5
+        blocked = asyncio.Event()
+
+        async def _blocked_heartbeat(**_):
+            await blocked.wait()
+        emu_svc.contact_svc.handle_heartbeat.side_effect = _blocked_heartbeat
+        resp = await client.post('/plugins/emu/beacons', data=json.dumps(dict(guid='abc')))
+        assert resp.status == 202
+        await asyncio.sleep(0)
+        resp = await client.post('/plugins/emu/beacons', data=json.dumps(dict(guid='def')))
+        assert resp.status == 202
+        resp = await client.post('/plugins/emu/beacons', data=json.dumps(dict(guid='ghi')))
+        assert resp.status == 429
+        assert resp.headers['Retry-After'] == '5'
+
+        resp = await client.post('/plugins/emu/beacons/bulk', data=json.dumps([dict(guid='jkl')]))
+        body = await resp.json()
+        assert resp.headers['Retry-After'] == '5'
+        assert body['results'] == [dict(index=0, status='rejected', error='beacon queue is full')]
+
+    async def test_identical_beacons_are_coalesced(self, emu_svc):
+        agent = DummyAgent()
+        emu_svc.contact_svc.handle_heartbeat = AsyncMock(return_value=(agent, []))
+        emu_svc.beacon_coalesce_window = 60
+        emu_svc.beacon_coalesce_max_entries = 2
+        profile = emu_svc._get_beacon_profile(dict(guid='abc', pid=1))
+
+        assert await emu_svc._handle_beacon(profile) == (agent, [])
+        agent.last_seen = datetime(2020, 1, 1, tzinfo=timezone.utc)
+        assert await emu_svc._handle_beacon(dict(profile)) == (agent, [])
+        assert emu_svc.contact_svc.handle_heartbeat.await_count == 1
+        assert agent.last_seen > datetime(2020, 1, 1, tzinfo=timezone.utc)
+
+        await emu_svc._handle_beacon(emu_svc._get_beacon_profile(dict(guid='abc', pid=2)))
+        assert emu_svc.contact_svc.handle_heartbeat.await_count == 2
+
+        await emu_svc._handle_beacon(emu_svc._get_beacon_profile(dict(guid='def')))
+        await emu_svc._handle_beacon(emu_svc._get_beacon_profile(dict(guid='ghi')))
+        assert list(emu_svc._coalesced_beacons) == ['def', 'ghi']
+
+    async def test_beacons_are_not_coalesced_outside_window(self, emu_svc):
+        emu_svc.beacon_coalesce_window = 60
+        profile = emu_svc._get_beacon_profile(dict(guid='abc'))
+        await emu_svc._handle_beacon(profile)
+        emu_svc._coalesced_beacons['abc']['time'] -= 61
+        await emu_svc._handle_beacon(profile)
+        assert emu_svc.contact_svc.handle_heartbeat.await_count == 2
+
+    @pytest.mark.parametrize('body, error', [
+        ('{"guid": "abc"', 'Invalid forwarded beacon: '),
+        ('["abc"]', 'Invalid forwarded beacon: expected a JSON object'),
+        ('{"hostName": "host1"}', "Invalid forwarded beacon: field 'guid' must be a non-empty string"),
+        ('{"guid": "abc", "pid": "12a"}', "Invalid forwarded beacon: field 'pid' must be an integer"),
+        ('{"guid": "abc", "pid": true}', "Invalid forwarded beacon: field 'pid' must be of type int or str"),
+        ('{"guid": "abc", "user": 5}', "Invalid forwarded beacon: field 'user' must be of type str"),
+    ])
+    async def test_malformed_beacons_are_rejected(self, emu_svc, beacon_client, body, error):
+        client = await beacon_client
+        resp = await client.post('/plugins/emu/beacons', data=body)
+        assert resp.status == 400
+        assert (await resp.text()).startswith(error)
+        emu_svc.contact_svc.handle_heartbeat.assert_not_called()
+
+    async def test_oversized_beacons_are_rejected(self, emu_svc, beacon_client):
+        client = await beacon_client
+        emu_svc.beacon_max_body_size = 64
+        resp = await client.post('/plugins/emu/beacons', data=json.dumps(dict(guid='abc', user='u' * 64)))
+        assert resp.status == 413
+        emu_svc.contact_svc.handle_heartbeat.assert_not_called()
+
+    async def test_beacon_string_pids_are_accepted(self, emu_svc, beacon_client):
+        client = await beacon_client
+        resp = await client.post('/plugins/emu/beacons', data=json.dumps(dict(guid='abc', pid='10', ppid=1)))
+        assert resp.status == 200
+        assert emu_svc.contact_svc.heartbeats[0]['pid'] == '10'
+
+    async def test_beacon_stream(self, emu_svc, aiohttp_client):
+        app = web.Application()
+        app.router.add_route('GET', '/plugins/emu/beacons/ws', emu_svc.handle_beacon_stream)
+        client = await aiohttp_client(app)
+        frames = emu_metrics.beacon_request_seconds.get(endpoint='stream')['count']
+        async with client.ws_connect('/plugins/emu/beacons/ws') as ws:
+            await ws.send_str(json.dumps(dict(guid='abc', hostName='host1')))
+            await ws.send_str('{not json')
+            await ws.send_str(json.dumps(dict(guid='fail')))
+            await ws.send_bytes(json.dumps(dict(guid='def')).encode())
+            acks = sorted([await ws.receive_json() for _ in range(4)], key=lambda ack: ack['index'])
+        assert [(ack['index'], ack['status']) for ack in acks] == [(0, 'ok'), (1, 'error'), (2, 'error'), (3, 'ok')]
+        assert acks[0]['paw'] == 'abc'
+        assert acks[2]['error'] == 'heartbeat failed'
+        assert sorted(heartbeat['paw'] for heartbeat in emu_svc.contact_svc.heartbeats) == ['abc', 'def']
+        assert emu_metrics.beacon_request_seconds.get(endpoint='stream')['count'] == frames + 4
@@ -0,0 +1,52 @@
+import pytest
+
+from plugins.emu.app.emu_metrics import MetricsRegistry
+
+
+@pytest.fixture
+def registry():
+    return MetricsRegistry()
+
+
+class TestEmuMetrics:
+    def test_counter_render(self, registry):
+        counter = registry.counter('emu_test_total', 'Test counter.')
+        counter.inc(endpoint='single', status='ok')
+        counter.inc(2, endpoint='single', status='ok')
+        counter.inc(endpoint='bulk', status='error')
+        assert counter.get(endpoint='single', status='ok') == 3
+        assert registry.render().splitlines() == [
+            '# HELP emu_test_total Test counter.',
+            '# TYPE emu_test_total counter',
+            'emu_test_total{endpoint="bulk",status="error"} 1',
+            'emu_test_total{endpoint="single",status="ok"} 3',
+        ]
+
+    def test_histogram_render(self, registry):
+        histogram = registry.histogram('emu_test_seconds', 'Test histogram.', buckets=(0.1, 1))
+        histogram.observe(0.05, phase='clone')
+        histogram.observe(0.5, phase='clone')
+        histogram.observe(2.0, phase='clone')
+        assert registry.render().splitlines() == [
+            '# HELP emu_test_seconds Test histogram.',
+            '# TYPE emu_test_seconds histogram',
+            'emu_test_seconds_bucket{phase="clone",le="0.1"} 1',
+            'emu_test_seconds_bucket{phase="clone",le="1"} 2',
+            'emu_test_seconds_bucket{phase="clone",le="+Inf"} 3',
+            'emu_test_seconds_sum{phase="clone"} 2.55',
+            'emu_test_seconds_count{phase="clone"} 3',
+        ]
+
+    def test_histogram_timer(self, registry):
+        histogram = registry.histogram('emu_test_seconds', 'Test histogram.')
+        with pytest.raises(RuntimeError):
+            with histogram.time(bucket='test'):
+                raise RuntimeError()
+        assert histogram.get(bucket='test')['count'] == 1
+
+    def test_label_values_are_escaped(self, registry):
+        registry.counter('emu_test_total', 'Test counter.').inc(name='a "quoted"\nvalue')
+        assert 'emu_test_total{name="a \\"quoted\\"\\nvalue"} 1' in registry.render()
+
+    def test_metrics_are_registered_once(self, registry):
+        assert registry.counter('emu_test_total', 'Test counter.') is registry.counter('emu_test_total', 'Other.')
@@ -0,0 +1,127 @@
+import os
+import shutil
+import tarfile
+
+import pytest
+import yaml
+
+from unittest.mock import AsyncMock, patch
+
+from plugins.emu.app import emu_snapshot
+from plugins.emu.app.emu_svc import EmuService
+
+
+@pytest.fixture
+def library(tmp_path):
+    plan_dir = tmp_path / 'library' / 'plan1' / 'Emulation_Plan' / 'yaml'
+    plan_dir.mkdir(parents=True)
+    (plan_dir / 'plan1.yaml').write_text(yaml.dump([
+        dict(emulation_plan_details=dict(id='planid1', adversary_name='Adversary 1', format_version=1.0)),
+        dict(id='ability1', name='Ability 1', tactic='discovery',
+             platforms=dict(linux=dict(sh=dict(command='whoami', payloads=['payload1'])))),
+    ]))
+    (tmp_path / 'library' / 'plan1' / 'Resources').mkdir()
+    (tmp_path / 'library' / 'plan1' / 'Resources' / 'payload1').write_text('payload contents')
+    return tmp_path / 'library'
+
+
+@pytest.fixture
+def snapshot(library, tmp_path):
+    async def _build():
+        emu_svc = EmuService()
+        emu_svc.repo_dir = str(library)
+        with patch.object(EmuService, 'decrypt_payloads', new=AsyncMock()):
+            metadata = await emu_snapshot.build_snapshot(emu_svc, str(tmp_path / 'snapshot.tar.gz'), clone=False)
+        return str(tmp_path / 'snapshot.tar.gz'), metadata
+    return _build
+
+
+@pytest.fixture
+def target_svc(tmp_path):
+    emu_svc = EmuService()
+    emu_svc.data_dir = str(tmp_path / 'target' / 'data')
+    emu_svc.payloads_dir = str(tmp_path / 'target' / 'payloads')
+    return emu_svc
+
+
+class TestEmuSnapshot:
+    async def test_build_snapshot(self, snapshot):
+        snapshot_path, metadata = await snapshot()
+        assert metadata['format_version'] == emu_snapshot.SNAPSHOT_FORMAT_VERSION
+        assert emu_snapshot.read_checksum(snapshot_path) == emu_snapshot.compute_checksum(snapshot_path)
+        with tarfile.open(snapshot_path) as archive:
+            names = set(archive.getnames())
+        assert {'snapshot.json', 'data/abilities/discovery/ability1.yml', 'data/adversaries/planid1.yml',
+                'payloads/payload1'}.issubset(names)
+
+    async def test_install_snapshot(self, snapshot, target_svc, tmp_path):
+        snapshot_path, _ = await snapshot()
+        assert await target_svc.install_snapshot(snapshot_path)
+        target = tmp_path / 'target'
+        assert (target / 'payloads' / 'payload1').read_text() == 'payload contents'
+        with open(target / 'data' / 'abilities' / 'discovery' / 'ability1.yml') as f:
+            assert yaml.safe_load(f)[0]['name'] == 'Ability 1'
+        assert target_svc.ingestion_status['phase'] == 'ready'
+
+        with patch.object(emu_snapshot, 'compute_checksum', wraps=emu_snapshot.compute_checksum) as compute_checksum:
+            assert await target_svc.install_snapshot(snapshot_path)
+        compute_checksum.assert_not_called()
+
+        os.remove(target / 'payloads' / 'payload1')
+        assert await target_svc.install_snapshot(snapshot_path)
+        assert (target / 'payloads' / 'payload1').read_text() == 'payload contents'
+
+    async def test_install_snapshot_rejects_checksum_mismatch(self, snapshot, target_svc, tmp_path):
+        snapshot_path, _ = await snapshot()
+        with open(emu_snapshot.checksum_path(snapshot_path), 'w') as f:
+            f.write('0' * 64)
+        assert not await target_svc.install_snapshot(snapshot_path)
+        assert not (tmp_path / 'target' / 'data').exists()
+
+    async def test_install_snapshot_without_metadata(self, target_svc, tmp_path):
+        snapshot_path = str(tmp_path / 'snapshot.tar.gz')
+        payload_path = tmp_path / 'payload1'
+        payload_path.write_text('payload contents')
+        with tarfile.open(snapshot_path, 'w:gz') as archive:
+            archive.add(str(payload_path), arcname='payloads/payload1')
+        with open(emu_snapshot.checksum_path(snapshot_path), 'w') as f:
+            f.write('%s  snapshot.tar.gz\n' % emu_snapshot.compute_checksum(snapshot_path))
+        assert not await target_svc.install_snapshot(snapshot_path)
+        assert target_svc.ingestion_status['phase'] != 'ready'
+
+    async def test_install_corrupt_snapshot(self, target_svc, tmp_path):
+        snapshot_path = str(tmp_path / 'snapshot.tar.gz')
+        with open(snapshot_path, 'wb') as f:
+            f.write(b'not a tarball')
+        with open(emu_snapshot.checksum_path(snapshot_path), 'w') as f:
+            f.write('%s  snapshot.tar.gz\n' % emu_snapshot.compute_checksum(snapshot_path))
+        assert not await target_svc.install_snapshot(snapshot_path)
+
+    async def test_install_missing_snapshot(self, target_svc, tmp_path):
+        assert not await target_svc.install_snapshot(str(tmp_path / 'missing.tar.gz'))
+
+    async def test_install_snapshot_without_archive(self, target_svc, tmp_path):
+        snapshot_path = str(tmp_path / 'snapshot.tar.gz')
+        with open(emu_snapshot.checksum_path(snapshot_path), 'w') as f:
+            f.write('0' * 64)
+        assert not await target_svc.install_snapshot(snapshot_path)
+
+    async def test_failed_install_leaves_files_untouched(self, snapshot, target_svc, tmp_path):
+        snapshot_path, _ = await snapshot()
+        target = tmp_path / 'target'
+        (target / 'payloads').mkdir(parents=True)
+        (target / 'payloads' / 'payload1').write_text('previous contents')
+        copies = []
+        copyfileobj = shutil.copyfileobj
+
+        def _copyfileobj(src, dst):
+            copies.append(dst.name)
+            if len(copies) > 1:
+                raise OSError('No space left on device')
+            copyfileobj(src, dst)
+        with patch.object(shutil, 'copyfileobj', wraps=_copyfileobj):
+            assert not await target_svc.install_snapshot(snapshot_path)
+        assert len(copies) == 2
+        assert (target / 'payloads' / 'payload1').read_text() == 'previous contents'
+        assert not (target / 'data').exists()
+        assert [path for path in os.listdir(target) if path.startswith('.emu_snapshot_')] == []
@@ -1,14 +1,20 @@
 import glob
+import json
+import os
 import yaml
 import shutil
 
 import asyncio
 import pytest
+import subprocess
+import tarfile
+import zipfile
 
-from pathlib import Path, PosixPath
-from unittest.mock import patch, call
+from pathlib import Path
+from unittest.mock import AsyncMock, patch, call
 
 from app.utility.base_world import BaseWorld
+from plugins.emu.app import emu_metrics, emu_svc as emu_svc_module
 from plugins.emu.app.emu_svc import EmuService
 
 
@@ -141,6 +147,75 @@ def sample_emu_plan():
 ''')
 
 
+@pytest.fixture
+def emu_library(sample_emu_plan, tmp_path):
+    library_dir = tmp_path / 'library'
+    for plan_num in range(3):
+        plan_dir = library_dir / ('plan%d' % plan_num) / 'Emulation_Plan' / 'yaml'
+        plan_dir.mkdir(parents=True)
+        plan = yaml.safe_load(yaml.dump(sample_emu_plan))
+        plan[0]['emulation_plan_details']['id'] = 'planid%d' % plan_num
+        plan[0]['emulation_plan_details']['adversary_name'] = 'Adversary %d' % plan_num
+        for ability in plan[1:]:
+            ability['id'] = '%s-%d' % (ability['id'], plan_num)
+        (plan_dir / ('plan%d.yaml' % plan_num)).write_text(yaml.dump(plan))
+    return library_dir
+
+
+CRYPT_SCRIPT = '''
+import os
+import sys
+
+plan_path = sys.argv[sys.argv.index('-i') + 1]
+with open(os.path.join(plan_path, 'runs.txt'), 'a') as f:
+    f.write('run\\n')
+print('[+] decrypted payloads in %s' % plan_path)
+sys.exit(int(os.environ.get('EMU_TEST_CRYPT_EXIT_CODE', '0')))
+'''
+
+
+def create_crypt_script(library_dir, plan_name):
+    resources_dir = library_dir / plan_name / 'Resources'
+    (resources_dir / 'utilities').mkdir(parents=True)
+    (resources_dir / 'utilities' / 'crypt_executables.py').write_text(CRYPT_SCRIPT)
+    (resources_dir / 'payload.zip').write_bytes(b'encrypted')
+    return resources_dir
+
+
+def create_library_repo(repo_dir):
+    for path in ('plan1/Emulation_Plan/yaml/plan1.yaml', 'plan1/Resources/payload.exe', 'plan1/README.md',
+                 'plan1/Emulation_Plan/plan1.md'):
+        (repo_dir / path).parent.mkdir(parents=True, exist_ok=True)
+        (repo_dir / path).write_text(path)
+    commit_library_repo(repo_dir, init=True)
+
+
+def commit_library_repo(repo_dir, init=False):
+    git = ['git', '-C', str(repo_dir), '-c', 'user.name=test', '-c', 'user.email=test@example.com']
+    if init:
+        subprocess.check_call(git + ['init', '-q'])
+    subprocess.check_call(git + ['add', '-A'])
+    subprocess.check_call(git + ['commit', '-q', '-m', 'update'])
+
+
+def point_emu_svc_at(emu_svc, library_dir, output_dir):
+    emu_svc.repo_dir = str(library_dir)
+    emu_svc.data_dir = str(output_dir / 'data')
+    emu_svc.payloads_dir = str(output_dir / 'payloads')
+    emu_svc.manifest_path = str(output_dir / 'data' / 'ingestion_manifest.json')
+    emu_svc.decryption_record_path = str(output_dir / 'data' / 'decryption_manifest.json')
+
+
+def read_tree(root):
+    contents = dict()
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            with open(path) as f:
+                contents[os.path.relpath(path, root)] = f.read()
+    return contents
+
+
 class TestEmuSvc:
     LIBRARY_GLOB_PATH = 'plugins/emu/data/adversary-emulation-plans/*'
     PLANNER_GLOB_PATH = 'plugins/emu/data/adversary-emulation-plans/*/Emulation_Plan/yaml/planners/*.yml'
@@ -222,23 +297,222 @@ class TestEmuSvc:
             )),
         ])
 
-    def test_store_required_payloads(self, emu_svc):
-        def _rglob(_, target):
-            return [PosixPath('/path/to/' + target), PosixPath('/path2/to/' + target)]
-
-        emu_svc.required_payloads = {'payload1', 'payload2', 'payload3'}
-        with patch.object(Path, 'rglob', new=_rglob):
-            with patch.object(shutil, 'copyfile', return_value=None) as new_copyfile:
+    def test_store_required_payloads(self, emu_svc, tmp_path):
+        for directory in ('a', 'b/c'):
+            (tmp_path / 'repo' / directory).mkdir(parents=True)
+            for payload in ('payload1', 'payload2', 'payload3'):
+                (tmp_path / 'repo' / directory / payload).write_text(directory)
+        emu_svc.repo_dir = str(tmp_path / 'repo')
+        emu_svc.required_payloads = {'payload1', 'payload2', 'payload3', 'missing'}
+        with patch.object(shutil, 'copyfile', return_value=None) as new_copyfile:
+            with patch.object(Path, 'rglob') as new_rglob:
                 emu_svc._store_required_payloads()
+        new_rglob.assert_not_called()
         assert new_copyfile.call_count == 3
         new_copyfile.assert_has_calls([
-            call(PosixPath('/path/to/payload1'), 'plugins/emu/payloads/payload1'),
-            call(PosixPath('/path/to/payload2'), 'plugins/emu/payloads/payload2'),
-            call(PosixPath('/path/to/payload3'), 'plugins/emu/payloads/payload3'),
+            call(tmp_path / 'repo' / 'a' / 'payload1', 'plugins/emu/payloads/payload1'),
+            call(tmp_path / 'repo' / 'a' / 'payload2', 'plugins/emu/payloads/payload2'),
+            call(tmp_path / 'repo' / 'a' / 'payload3', 'plugins/emu/payloads/payload3'),
         ], any_order=True)
+        assert emu_svc.payload_lookup_stats == dict(hits=3, misses=1)
+
+    def test_store_required_payloads_falls_back_to_next_match(self, emu_svc, tmp_path):
+        for directory in ('a', 'b'):
+            (tmp_path / 'repo' / directory).mkdir(parents=True)
+            (tmp_path / 'repo' / directory / 'payload1').write_text(directory)
+        emu_svc.repo_dir = str(tmp_path / 'repo')
+        emu_svc.required_payloads = {'payload1'}
+        with patch.object(shutil, 'copyfile', side_effect=[IOError('copy failed'), None]) as new_copyfile:
+            emu_svc._store_required_payloads()
+        new_copyfile.assert_has_calls([
+            call(tmp_path / 'repo' / 'a' / 'payload1', 'plugins/emu/payloads/payload1'),
+            call(tmp_path / 'repo' / 'b' / 'payload1', 'plugins/emu/payloads/payload1'),
+        ])
 
     def test_register_required_payloads(self, emu_svc):
         payloads = ['payload1', 'payload2', 'payload3', 'sandcat.go-darwin', 'sandcat.go-linux', 'sandcat.go-windows']
         want = {'payload1', 'payload2', 'payload3'}
         emu_svc._register_required_payloads(payloads)
         assert emu_svc.required_payloads == want
+
+    async def test_incremental_ingestion_skips_unchanged_plans(self, emu_svc, sample_emu_plan, tmp_path):
+        library_dir = tmp_path / 'library'
+        plan_dir = library_dir / 'plan1' / 'Emulation_Plan' / 'yaml'
+        plan_dir.mkdir(parents=True)
+        plan_path = plan_dir / 'plan1.yaml'
+        plan_path.write_text(yaml.dump(sample_emu_plan))
+        point_emu_svc_at(emu_svc, library_dir, tmp_path)
+
+        await emu_svc._load_adversaries_and_abilities(str(library_dir / '*'))
+        manifest = emu_svc._read_ingestion_manifest()
+        record = manifest[str(plan_path)]
+        assert record['ingested'] == 3
+        assert len(record['abilities']) == 3
+        assert record['adversary'] == str(tmp_path / 'data' / 'adversaries' / 'planid123.yml')
+        assert record['payloads'] == ['payload1A', 'payload1B', 'payload2A']
+
+        emu_svc.required_payloads = set()
+        with patch.object(BaseWorld, 'strip_yml') as new_strip_yml:
+            await emu_svc._load_adversaries_and_abilities(str(library_dir / '*'))
+        new_strip_yml.assert_not_called()
+        assert {'payload1A', 'payload1B', 'payload2A'} == emu_svc.required_payloads
+
+        changed_plan = sample_emu_plan[:2]
+        changed_plan[1]['name'] = 'Changed ability'
+        plan_path.write_text(yaml.dump(changed_plan))
+        await emu_svc._load_adversaries_and_abilities(str(library_dir / '*'))
+        record = emu_svc._read_ingestion_manifest()[str(plan_path)]
+        assert len(record['abilities']) == 1
+        assert not (tmp_path / 'data' / 'abilities' / 'tactic2' / '2-3-4.yml').exists()
+        with open(record['abilities'][0]) as f:
+            assert yaml.safe_load(f)[0]['name'] == 'Changed ability'
+
+    async def test_parallel_ingestion_matches_serial(self, emu_library, tmp_path):
+        serial_svc, parallel_svc = EmuService(), EmuService()
+        serial_svc.incremental_ingestion = parallel_svc.incremental_ingestion = False
+        point_emu_svc_at(serial_svc, emu_library, tmp_path / 'serial')
+        point_emu_svc_at(parallel_svc, emu_library, tmp_path / 'parallel')
+        parallel_svc.ingestion_workers = 2
+
+        parsed = []
+        for svc in (serial_svc, parallel_svc):
+            count = emu_metrics.ingestion_phase_seconds.get(phase='plan_parse')['count']
+            await svc._load_adversaries_and_abilities(str(emu_library / '*'))
+            parsed.append(emu_metrics.ingestion_phase_seconds.get(phase='plan_parse')['count'] - count)
+        assert parsed[0] > 1
+        assert parsed[0] == parsed[1]
+        serial_data = read_tree(tmp_path / 'serial' / 'data')
+        assert len(serial_data) == 15
+        assert serial_data == read_tree(tmp_path / 'parallel' / 'data')
+        assert serial_svc.required_payloads == parallel_svc.required_payloads
+
+    async def test_decrypt_payloads_skips_decrypted_plans(self, emu_svc, tmp_path):
+        library_dir = tmp_path / 'library'
+        resources = [create_crypt_script(library_dir, 'plan%d' % i) for i in range(3)]
+        point_emu_svc_at(emu_svc, library_dir, tmp_path)
+
+        await emu_svc.decrypt_payloads()
+        await emu_svc.decrypt_payloads()
+        assert [(r / 'runs.txt').read_text() for r in resources] == ['run\n'] * 3
+
+        (resources[1] / 'payload.zip').write_bytes(b'updated encrypted payload')
+        await emu_svc.decrypt_payloads()
+        assert [(r / 'runs.txt').read_text() for r in resources] == ['run\n', 'run\nrun\n', 'run\n']
+
+    async def test_decrypt_payloads_raises_on_failure(self, emu_svc, tmp_path, monkeypatch):
+        library_dir = tmp_path / 'library'
+        resources_dir = create_crypt_script(library_dir, 'plan1')
+        point_emu_svc_at(emu_svc, library_dir, tmp_path)
+        monkeypatch.setenv('EMU_TEST_CRYPT_EXIT_CODE', '1')
+
+        with pytest.raises(subprocess.CalledProcessError):
+            await emu_svc.decrypt_payloads()
+        assert str(resources_dir) not in emu_svc._read_decryption_records()
+
+    async def test_decrypt_payloads_in_process(self, emu_svc, tmp_path):
+        pyminizip = pytest.importorskip('pyminizip')
+        library_dir = tmp_path / 'library'
+        resources_dir = create_crypt_script(library_dir, 'plan1')
+        (tmp_path / 'payload.exe').write_bytes(b'payload contents' * 1000)
+        pyminizip.compress(str(tmp_path / 'payload.exe'), 'binaries', str(resources_dir / 'payload.zip'), 'malware', 5)
+        point_emu_svc_at(emu_svc, library_dir, tmp_path)
+        emu_svc.decrypt_in_process = True
+        emu_svc.decrypt_chunk_size = 1024
+        cwd = os.getcwd()
+
+        await emu_svc.decrypt_payloads()
+        assert (resources_dir / 'binaries' / 'payload.exe').read_bytes() == b'payload contents' * 1000
+        assert not (resources_dir / 'runs.txt').exists()
+        assert os.getcwd() == cwd
+        assert not emu_svc._decrypt_pool
+
+    async def test_decrypt_payloads_in_process_without_pyminizip(self, emu_svc, tmp_path, monkeypatch):
+        pyminizip = pytest.importorskip('pyminizip')
+        library_dir = tmp_path / 'library'
+        resources_dir = create_crypt_script(library_dir, 'plan1')
+        (tmp_path / 'payload.exe').write_bytes(b'payload contents' * 1000)
+        pyminizip.compress(str(tmp_path / 'payload.exe'), 'binaries', str(resources_dir / 'payload.zip'), 'malware', 5)
+        point_emu_svc_at(emu_svc, library_dir, tmp_path)
+        monkeypatch.setattr(emu_svc_module, 'pyminizip', None)
+        emu_svc.decrypt_in_process = True
+        emu_svc.decrypt_chunk_size = 1024
+
+        await emu_svc.decrypt_payloads()
+        assert (resources_dir / 'binaries' / 'payload.exe').read_bytes() == b'payload contents' * 1000
+        assert not (resources_dir / 'runs.txt').exists()
+
+    def test_extract_encrypted_archive_rejects_path_traversal(self, emu_svc, tmp_path):
+        archive_path = tmp_path / 'Resources' / 'payload.zip'
+        archive_path.parent.mkdir()
+        with zipfile.ZipFile(archive_path, 'w') as archive:
+            archive.writestr('../outside.exe', b'malicious')
+        with pytest.raises(ValueError):
+            emu_svc._extract_encrypted_archive(str(archive_path))
+        assert not (tmp_path / 'outside.exe').exists()
+
+    async def test_sparse_repo_sync(self, emu_svc, tmp_path):
+        source_dir = tmp_path / 'source'
+        create_library_repo(source_dir)
+        emu_svc.repo_dir = str(tmp_path / 'checkout')
+        emu_svc.sparse_repo_sync = True
+
+        await emu_svc.clone_repo(repo_url='file://%s' % source_dir)
+        checkout = tmp_path / 'checkout'
+        assert (checkout / 'plan1' / 'Emulation_Plan' / 'yaml' / 'plan1.yaml').exists()
+        assert (checkout / 'plan1' / 'Resources' / 'payload.exe').exists()
+        assert not (checkout / 'plan1' / 'README.md').exists()
+        assert not (checkout / 'plan1' / 'Emulation_Plan' / 'plan1.md').exists()
+
+        (source_dir / 'plan1' / 'Resources' / 'payload.exe').write_text('updated')
+        commit_library_repo(source_dir)
+        await emu_svc.clone_repo(repo_url='file://%s' % source_dir)
+        assert (checkout / 'plan1' / 'Resources' / 'payload.exe').read_text() == 'updated'
+
+    async def test_sparse_repo_sync_from_tarball(self, emu_svc, tmp_path):
+        source_dir = tmp_path / 'adversary_emulation_library-master'
+        create_library_repo(source_dir)
+        tarball_path = tmp_path / 'library.tar.gz'
+        with tarfile.open(tarball_path, 'w:gz') as tarball:
+            tarball.add(source_dir, arcname=source_dir.name)
+        emu_svc.repo_dir = str(tmp_path / 'checkout')
+        emu_svc.sparse_repo_sync = True
+
+        await emu_svc.clone_repo(repo_url=str(tarball_path))
+        checkout = tmp_path / 'checkout'
+        assert (checkout / 'plan1' / 'Emulation_Plan' / 'yaml' / 'plan1.yaml').exists()
+        assert (checkout / 'plan1' / 'Resources' / 'payload.exe').exists()
+        assert not (checkout / 'plan1' / 'README.md').exists()
+        assert not (checkout / '.git').exists()
+
+        (checkout / 'plan1' / 'Resources' / 'payload.exe').unlink()
+        await emu_svc.clone_repo(repo_url=str(tarball_path))
+        assert not (checkout / 'plan1' / 'Resources' / 'payload.exe').exists()
+
+    async def test_background_ingestion_reports_status(self, emu_svc, emu_library, tmp_path):
+        point_emu_svc_at(emu_svc, emu_library, tmp_path)
+        response = await emu_svc.handle_status(None)
+        assert response.status == 503
+        assert json.loads(response.text)['phase'] == 'idle'
+
+        with patch.object(EmuService, 'decrypt_payloads', new=AsyncMock()):
+            with patch.object(EmuService, '_load_generated_files', new=AsyncMock()) as load_generated_files:
+                await emu_svc.start_background_ingestion()
+        response = await emu_svc.handle_status(None)
+        status = json.loads(response.text)
+        assert response.status == 200
+        assert status['ready'] and status['phase'] == 'ready'
+        assert status['progress']['abilities'] == dict(files_total=3, files_processed=3, total=9, ingested=9, errors=0)
+        assert not status['errors']
+        load_generated_files.assert_awaited_once()
+        assert len(emu_svc.generated_files['abilities']) == 9
+        assert len(emu_svc.generated_files['adversaries']) == 3
+
+    async def test_background_ingestion_reports_failure(self, emu_svc, emu_library, tmp_path):
+        point_emu_svc_at(emu_svc, emu_library, tmp_path)
+        with patch.object(EmuService, 'decrypt_payloads', new=AsyncMock(side_effect=RuntimeError('bad payload'))):
+            await emu_svc.start_background_ingestion()
+        response = await emu_svc.handle_status(None)
+        status = json.loads(response.text)
+        assert response.status == 503
+        assert status['phase'] == 'failed'
+        assert status['errors'] == ['RuntimeError: bad payload']
@@ -1,3 +1,6 @@
+import asyncio
+import itertools
+
 import pytest
 
 from app.objects.secondclass.c_link import Link
@@ -7,6 +10,10 @@ from plugins.emu.app.group_filtered_planner import LogicalPlanner
 BUCKET_NAME = 'fetch_and_run_links'
 
 
+def get_queued_links(planner):
+    return list(itertools.chain.from_iterable(planner.pending_links.values()))
+
+
 class DummyOperation:
     def __init__(self, dummy_adversary, dummy_agents):
         self.adversary = dummy_adversary
@@ -19,20 +26,95 @@ class DummyOperation:
         return link
 
 
+class DummyFact:
+    def __init__(self, trait, value, score=1):
+        self.trait = trait
+        self.value = value
+        self.score = score
+
+    @property
+    def unique(self):
+        return '%s%s' % (self.trait, self.value)
+
+
+class DummyFactOperation(DummyOperation):
+    def __init__(self, dummy_adversary, dummy_agents, updates_by_step=None):
+        super().__init__(dummy_adversary, dummy_agents)
+        self.facts = [DummyFact('host.user.name', 'guest')]
+        self.updates_by_step = updates_by_step or dict()
+        self.steps = 0
+        self.applied = []
+
+    async def apply(self, link):
+        self.applied.append((link.paw, link.ability.ability_id))
+        return link
+
+    async def wait_for_links_completion(self, _):
+        await asyncio.sleep(0.01)
+        if self.steps in self.updates_by_step:
+            self.updates_by_step[self.steps](self)
+        self.steps += 1
+
+    async def all_facts(self):
+        return self.facts
+
+
 class DummyAdversary:
     def __init__(self, atomic_ordering):
         self.atomic_ordering = atomic_ordering
 
 
 class DummyAgent:
-    def __init__(self, paw, group):
+    def __init__(self, paw, group, platform=None, executors=None):
         self.paw = paw
         self.group = group
+        self.platform = platform
+        self.executors = executors
 
 
 class DummyAbility:
-    def __init__(self, ability_id):
+    def __init__(self, ability_id, executors=None):
         self.ability_id = ability_id
+        if executors is not None:
+            self.executors = executors
+
+
+class DummyExecutor:
+    def __init__(self, platform, name):
+        self.platform = platform
+        self.name = name
+
+
+class DummyDataService:
+    def __init__(self, abilities=None):
+        self.abilities = abilities
+        self.lookups = []
+
+    async def locate(self, object_name, match):
+        self.lookups.append(match['ability_id'])
+        if self.abilities is not None:
+            return [ability for ability in self.abilities if ability.ability_id == match['ability_id']]
+        return [DummyAbility(match['ability_id'])]
+
+
+class DummyPlanningService:
+    def __init__(self, abilities=None):
+        self.data_svc = DummyDataService(abilities)
+        self.generated = []
+
+    def get_service(self, name):
+        return self.data_svc if name == 'data_svc' else None
+
+    async def generate_and_trim_links(self, agent, operation, abilities, trim=True):
+        self.generated.append((agent.paw, [ability.ability_id for ability in abilities]))
+        return [Link(command='test command', paw=agent.paw, ability=ability) for ability in abilities]
+
+    @staticmethod
+    async def sort_links(links):
+        return links
+
+    async def get_links(self, operation, agent=None):
+        raise AssertionError('links should be generated for a single ability')
 
 
 @pytest.fixture
@@ -106,7 +188,7 @@ def sample_filter():
 
 @pytest.fixture
 def generate_planner(potential_links_dict):
-    async def _get_links_mock(agent):
+    async def _get_links_mock(agent, ability_id=None):
         return potential_links_dict.get(agent.paw, [])
 
     def _generate_planner(atomic_ordering, agents, filtered_groups_by_ability=None):
@@ -129,16 +211,16 @@ def filtered_planner(generate_planner, dummy_agents, sample_abilities, sample_fi
 
 class TestGroupFilteredPlanner:
     async def test_fetch_from_pending_links(self, planner_without_filter, pending_links):
-        planner_without_filter.pending_links = pending_links
+        planner_without_filter.pending_links = planner_without_filter._queue_links(pending_links)
         links_to_use = planner_without_filter._fetch_from_pending_links()
         assert len(links_to_use) == 3
-        assert len(planner_without_filter.pending_links) == 1
+        assert len(get_queued_links(planner_without_filter)) == 1
         assert links_to_use[0].paw == 'paw1' and links_to_use[0].ability.ability_id == '123'
         assert links_to_use[0].command == 'test command'
         assert links_to_use[1].paw == 'paw2'
         assert links_to_use[2].paw == 'paw3'
-        assert planner_without_filter.pending_links[0].paw == 'paw1'
-        assert planner_without_filter.pending_links[0].command == 'test command variant'
+        assert get_queued_links(planner_without_filter)[0].paw == 'paw1'
+        assert get_queued_links(planner_without_filter)[0].command == 'test command variant'
 
     async def test_fetch_from_empty_pending_links(self, planner_without_filter):
         links_to_use = planner_without_filter._fetch_from_pending_links()
@@ -169,10 +251,10 @@ class TestGroupFilteredPlanner:
 
         # first pass
         links_to_use = await planner_without_filter._fetch_links()
-        assert len(planner_without_filter.pending_links) == 1
-        assert planner_without_filter.pending_links[0].paw == 'paw1'
-        assert planner_without_filter.pending_links[0].command == 'test command variant'
-        assert planner_without_filter.pending_links[0].ability.ability_id == '123'
+        assert len(get_queued_links(planner_without_filter)) == 1
+        assert get_queued_links(planner_without_filter)[0].paw == 'paw1'
+        assert get_queued_links(planner_without_filter)[0].command == 'test command variant'
+        assert get_queued_links(planner_without_filter)[0].ability.ability_id == '123'
         assert planner_without_filter.current_ability_index == 1
         assert len(links_to_use) == 2
         assert links_to_use[0].paw == 'paw1'
@@ -184,7 +266,7 @@ class TestGroupFilteredPlanner:
 
         # second pass - finishes links from first pass
         links_to_use = await planner_without_filter._fetch_links()
-        assert len(planner_without_filter.pending_links) == 0
+        assert len(get_queued_links(planner_without_filter)) == 0
         assert planner_without_filter.current_ability_index == 1
         assert len(links_to_use) == 1
         assert links_to_use[0].paw == 'paw1'
@@ -193,7 +275,7 @@ class TestGroupFilteredPlanner:
 
         # third pass - ability #2
         links_to_use = await planner_without_filter._fetch_links()
-        assert len(planner_without_filter.pending_links) == 0
+        assert len(get_queued_links(planner_without_filter)) == 0
         assert planner_without_filter.current_ability_index == 2
         assert len(links_to_use) == 2
         assert links_to_use[0].paw == 'paw1'
@@ -205,7 +287,7 @@ class TestGroupFilteredPlanner:
 
         # fourth pass - skip ability #3 and go to #4
         links_to_use = await planner_without_filter._fetch_links()
-        assert len(planner_without_filter.pending_links) == 0
+        assert len(get_queued_links(planner_without_filter)) == 0
         assert planner_without_filter.current_ability_index == 4
         assert len(links_to_use) == 2
         assert links_to_use[0].paw == 'paw1'
@@ -217,7 +299,7 @@ class TestGroupFilteredPlanner:
 
         # fifth pass - end
         links_to_use = await planner_without_filter._fetch_links()
-        assert len(planner_without_filter.pending_links) == 0
+        assert len(get_queued_links(planner_without_filter)) == 0
         assert planner_without_filter.current_ability_index == 4
         assert len(links_to_use) == 0
 
@@ -267,10 +349,10 @@ class TestGroupFilteredPlanner:
 
         # first pass
         links_to_use = await filtered_planner._fetch_links()
-        assert len(filtered_planner.pending_links) == 1
-        assert filtered_planner.pending_links[0].paw == 'paw1'
-        assert filtered_planner.pending_links[0].command == 'test command variant'
-        assert filtered_planner.pending_links[0].ability.ability_id == '123'
+        assert len(get_queued_links(filtered_planner)) == 1
+        assert get_queued_links(filtered_planner)[0].paw == 'paw1'
+        assert get_queued_links(filtered_planner)[0].command == 'test command variant'
+        assert get_queued_links(filtered_planner)[0].ability.ability_id == '123'
         assert filtered_planner.current_ability_index == 1
         assert len(links_to_use) == 1
         assert links_to_use[0].paw == 'paw1'
@@ -279,7 +361,7 @@ class TestGroupFilteredPlanner:
 
         # second pass - finishes links from first pass
         links_to_use = await filtered_planner._fetch_links()
-        assert len(filtered_planner.pending_links) == 0
+        assert len(get_queued_links(filtered_planner)) == 0
         assert filtered_planner.current_ability_index == 1
         assert len(links_to_use) == 1
         assert links_to_use[0].paw == 'paw1'
@@ -288,7 +370,7 @@ class TestGroupFilteredPlanner:
 
         # third pass - ability #2
         links_to_use = await filtered_planner._fetch_links()
-        assert len(filtered_planner.pending_links) == 0
+        assert len(get_queued_links(filtered_planner)) == 0
         assert filtered_planner.current_ability_index == 2
         assert len(links_to_use) == 2
         assert links_to_use[0].paw == 'paw1'
@@ -300,7 +382,7 @@ class TestGroupFilteredPlanner:
 
         # fourth pass - skip ability #3 and go to #4
         links_to_use = await filtered_planner._fetch_links()
-        assert len(filtered_planner.pending_links) == 0
+        assert len(get_queued_links(filtered_planner)) == 0
         assert filtered_planner.current_ability_index == 4
         assert len(links_to_use) == 2
         assert links_to_use[0].paw == 'paw1'
@@ -312,6 +394,207 @@ class TestGroupFilteredPlanner:
 
         # fifth pass - end
         links_to_use = await filtered_planner._fetch_links()
-        assert len(filtered_planner.pending_links) == 0
+        assert len(get_queued_links(filtered_planner)) == 0
         assert filtered_planner.current_ability_index == 4
         assert len(links_to_use) == 0
+
+    async def test_get_pending_links_is_ability_scoped(self, dummy_agents):
+        planning_svc = DummyPlanningService()
+        operation = DummyOperation(DummyAdversary(['123', '456', '123']), dummy_agents[:2])
+        planner = LogicalPlanner(operation, planning_svc)
+        links = await planner._get_pending_links('123')
+        assert [(link.paw, link.ability.ability_id) for link in links] == [('paw1', '123'), ('paw2', '123')]
+        assert planning_svc.generated == [('paw1', ['123']), ('paw2', ['123'])]
+        await planner._get_pending_links('123')
+        assert planning_svc.data_svc.lookups == ['123']
+
+    async def test_valid_agents_follow_agent_changes(self, filtered_planner):
+        def _get_valid_agent_paws():
+            return [agent.paw for agent in filtered_planner._get_valid_agents_for_ability('1011')]
+        assert _get_valid_agent_paws() == ['paw1', 'paw3', 'paw4']
+        filtered_planner.operation.agents[1].group = 'group3'
+        filtered_planner.operation.agents.append(DummyAgent('paw6', 'group1'))
+        # The index is only refreshed at the start of each planner step
+        assert _get_valid_agent_paws() == ['paw1', 'paw3', 'paw4']
+        filtered_planner._refresh_agent_index()
+        assert _get_valid_agent_paws() == ['paw1', 'paw2', 'paw3', 'paw4', 'paw6']
+
+    async def test_agents_are_only_checked_for_new_abilities(self, filtered_planner):
+        class DummyAgentList(list):
+            scans = 0
+
+            def __iter__(self):
+                DummyAgentList.scans += 1
+                return super().__iter__()
+        filtered_planner.operation.agents = DummyAgentList(filtered_planner.operation.agents)
+        await filtered_planner._fetch_links()
+        assert DummyAgentList.scans > 0
+        # The second pass only hands out the links queued for the first ability
+        DummyAgentList.scans = 0
+        await filtered_planner._fetch_links()
+        assert DummyAgentList.scans == 0
+        await filtered_planner._fetch_links()
+        assert DummyAgentList.scans > 0
+
+    async def test_get_pending_links_concurrently(self, dummy_agents, potential_links_dict):
+        active, max_active = 0, 0
+
+        async def _get_links_mock(agent, ability_id=None):
+            nonlocal active, max_active
+            active += 1
+            max_active = max(max_active, active)
+            await asyncio.sleep(0.01 if agent.paw == 'paw1' else 0)
+            active -= 1
+            return potential_links_dict.get(agent.paw, [])
+        operation = DummyOperation(DummyAdversary(['123']), dummy_agents)
+        planner = LogicalPlanner(operation, None, link_generation_concurrency=2)
+        planner._get_links = _get_links_mock
+        links = await planner._get_pending_links('123')
+        assert [(link.paw, link.command) for link in links] == [('paw1', 'test command'),
+                                                                ('paw1', 'test command variant'),
+                                                                ('paw2', 'test command')]
+        assert max_active == 2
+
+    @pytest.mark.parametrize('updates_by_step, expected_calls', [
+        (None, 6),
+        ({0: lambda operation: operation.facts.append(DummyFact('host.user.name', 'admin'))}, 9),
+        ({0: lambda operation: setattr(operation.facts[0], 'score', 2)}, 9),
+        ({0: lambda operation: setattr(operation.agents[0], 'platform', 'linux')}, 9),
+    ])
+    async def test_pipelined_planner(self, dummy_agents, potential_links_dict, updates_by_step, expected_calls):
+        calls = []
+
+        async def _get_links_mock(agent, ability_id=None):
+            calls.append(ability_id)
+            return potential_links_dict.get(agent.paw, [])
+        operation = DummyFactOperation(DummyAdversary(['456', '1011']), dummy_agents[:3], updates_by_step)
+        planner = LogicalPlanner(operation, None, pipelined=True, link_generation_concurrency=1)
+        planner._get_links = _get_links_mock
+        while planner.next_bucket:
+            await planner.fetch_and_run_links()
+        assert operation.applied == [('paw1', '456'), ('paw1', '1011'), ('paw3', '1011')]
+        assert len(calls) == expected_calls
+
+    @pytest.mark.parametrize('stopped', [False, True])
+    async def test_pipelined_planner_cancels_unused_prefetch(self, dummy_agents, potential_links_dict, stopped):
+        async def _get_links_mock(agent, ability_id=None):
+            if ability_id == '1011':
+                await asyncio.Event().wait()
+            return potential_links_dict.get(agent.paw, [])
+
+        class StoppingPlanningService:
+            async def execute_planner(self, planner):
+                await planner.fetch_and_run_links()
+                prefetched.append(planner._prefetch[2])
+                if stopped:
+                    # A stopping condition is met while the next ability is being prefetched
+                    planner.stopping_condition_met = True
+                    return
+                operation.agents.clear()
+                await planner.fetch_and_run_links()
+                assert planner.next_bucket is None
+        prefetched = []
+        operation = DummyFactOperation(DummyAdversary(['456', '1011']), dummy_agents[:3])
+        planner = LogicalPlanner(operation, StoppingPlanningService(), pipelined=True)
+        planner._get_links = _get_links_mock
+        await planner.execute()
+        assert operation.applied == [('paw1', '456')]
+        assert planner._prefetch is None
+        await asyncio.wait(prefetched, timeout=1)
+        assert prefetched[0].cancelled()
+
+    async def test_fetch_from_pending_links_round_robin(self, planner_without_filter):
+        links = [Link(command='command %d' % i, paw='paw%d' % (i % 3), ability=DummyAbility('123')) for i in range(8)]
+        planner_without_filter.pending_links = planner_without_filter._queue_links(links)
+        rounds = []
+        while planner_without_filter.pending_links:
+            rounds.append([link.command for link in planner_without_filter._fetch_from_pending_links()])
+        assert rounds == [['command 0', 'command 1', 'command 2'], ['command 3', 'command 4', 'command 5'],
+                          ['command 6', 'command 7']]
+
+    async def test_get_next_wave(self, generate_planner, dummy_agents, sample_abilities, sample_filter):
+        planner = generate_planner(sample_abilities, dummy_agents, filtered_groups_by_ability=sample_filter)
+        planner.scheduling = 'waves'
+        waves = []
+        while planner.current_ability_index < len(sample_abilities):
+            wave = planner._get_next_wave()
+            waves.append([ability_id for _, ability_id in wave])
+            planner.current_ability_index += len(wave)
+        assert waves == [['123'], ['456'], ['789', '1011']]
+
+    async def test_fetch_links_in_disjoint_wave(self, generate_planner, dummy_agents):
+        planner = generate_planner(['123', '1011'], dummy_agents,
+                                   filtered_groups_by_ability={'123': ['group2'], '1011': ['group1', 'group3']})
+        planner.scheduling = 'waves'
+        links_to_use = await planner._fetch_links()
+        assert [(link.paw, link.ability.ability_id) for link in links_to_use] == [('paw2', '123'), ('paw1', '1011'),
+                                                                                  ('paw3', '1011')]
+        assert planner.current_ability_index == 2
+        assert not planner.pending_links
+
+    async def test_fetch_links_in_independent_wave(self, generate_planner, dummy_agents):
+        planner = generate_planner(['123', '456', '1011'], dummy_agents)
+        planner.scheduling = 'waves'
+        planner.independent_abilities = {'123', '456'}
+        rounds = []
+        while True:
+            links_to_use = await planner._fetch_links()
+            if not links_to_use:
+                break
+            rounds.append([(link.paw, link.command, link.ability.ability_id) for link in links_to_use])
+        # Agents still run their links in profile order, and '1011' waits for the wave to complete.
+        assert rounds == [
+            [('paw1', 'test command', '123'), ('paw2', 'test command', '123'), ('paw4', 'test command', '456')],
+            [('paw1', 'test command variant', '123')],
+            [('paw1', 'test command', '456')],
+            [('paw1', 'test command', '1011'), ('paw3', 'test command', '1011')],
+        ]
+
+    async def test_unrunnable_abilities_are_skipped(self):
+        abilities = [DummyAbility('mac', [DummyExecutor('darwin', 'sh')]),
+                     DummyAbility('win', [DummyExecutor('windows', 'psh'), DummyExecutor('windows', 'cmd')]),
+                     DummyAbility('lin', [DummyExecutor('linux', 'sh')])]
+        agents = [DummyAgent('paw1', 'group1'), DummyAgent('paw2', 'group2')]
+        agents[0].platform, agents[0].executors = 'windows', ['cmd']
+        agents[1].platform, agents[1].executors = 'linux', ['sh']
+        planning_svc = DummyPlanningService(abilities)
+        operation = DummyOperation(DummyAdversary(['mac', 'missing', 'win', 'lin']), agents)
+        planner = LogicalPlanner(operation, planning_svc)
+
+        links_to_use = await planner._fetch_links()
+        assert [(link.paw, link.ability.ability_id) for link in links_to_use] == [('paw1', 'win')]
+        assert planner.current_ability_index == 3
+        assert planning_svc.generated == [('paw1', ['win'])]
+
+        # A linux agent joins the operation before the next step
+        agents.append(DummyAgent('paw3', 'group3'))
+        agents[2].platform, agents[2].executors = 'linux', ['sh', 'proc']
+        links_to_use = await planner._fetch_links()
+        assert [(link.paw, link.ability.ability_id) for link in links_to_use] == [('paw2', 'lin'), ('paw3', 'lin')]
+        assert planning_svc.generated[1:] == [('paw2', ['lin']), ('paw3', ['lin'])]
+
+    async def test_eligibility_follows_agent_platform_changes(self):
+        abilities = [DummyAbility('win', [DummyExecutor('windows', 'psh')]),
+                     DummyAbility('lin', [DummyExecutor('linux', 'sh')])]
+        agents = [DummyAgent('paw1', 'group1'), DummyAgent('paw2', 'group1'), DummyAgent('paw3', 'group2')]
+        agents[0].platform, agents[0].executors = 'windows', ['psh']
+        agents[1].platform, agents[1].executors = 'linux', ['sh']
+        agents[2].platform, agents[2].executors = 'linux', ['sh']
+        operation = DummyOperation(DummyAdversary(['win', 'lin']), agents)
+        planner = LogicalPlanner(operation, DummyPlanningService(abilities))
+        links_to_use = await planner._fetch_links()
+        assert [(link.paw, link.ability.ability_id) for link in links_to_use] == [('paw1', 'win')]
+
+        # paw1 now reports a linux platform and paw2 loses its sh executor
+        agents[0].platform, agents[0].executors = 'linux', ['sh']
+        agents[1].executors.remove('sh')
+        checked = []
+        is_eligible = planner._is_eligible
+
+        def _is_eligible(agent, ability_id, abilities):
+            checked.append((agent.paw, ability_id))
+            return is_eligible(agent, ability_id, abilities)
+        planner._is_eligible = _is_eligible
+        links_to_use = await planner._fetch_links()
+        assert [(link.paw, link.ability.ability_id) for link in links_to_use] == [('paw1', 'lin'), ('paw3', 'lin')]
+        assert sorted(checked) == [('paw1', 'lin'), ('paw1', 'win'), ('paw2', 'lin'), ('paw2', 'win')]
@@ -0,0 +1,12 @@
+from plugins.emu.tests.benchmarks.ingestion_benchmark import run_benchmark
+
+
+class TestIngestionBenchmark:
+    async def test_run_benchmark(self):
+        results = await run_benchmark(dict(plans=2, abilities=3, platforms=2, payloads=2, encrypted_payloads=0))
+        cold, warm = results['runs']['cold'], results['runs']['warm']
+        assert results['library']['abilities'] == 6
+        assert set(cold['phases']) == {'decrypt_payloads', 'load_plans', 'store_required_payloads', 'load_planners'}
+        assert cold['progress']['abilities']['ingested'] == 6
+        assert cold['payload_lookups'] == dict(hits=4, misses=0)
+        assert warm['payload_lookups'] == dict(hits=0, misses=0)
@@ -0,0 +1,74 @@
+import logging
+import shutil
+import time
+
+import pytest
+
+from unittest.mock import patch
+
+from plugins.emu.app import emu_metrics
+from plugins.emu.app.ingestion_writer import IngestionWriter
+
+
+@pytest.fixture
+def writer():
+    ingestion_writer = IngestionWriter(logging.getLogger('test_ingestion_writer'), max_workers=2, batch_size=3)
+    yield ingestion_writer
+    ingestion_writer.shutdown()
+
+
+class TestIngestionWriter:
+    async def test_write_creates_directories_and_files(self, writer, tmp_path):
+        futures = [writer.write(str(tmp_path / 'a' / ('%d.yml' % i)), 'content %d' % i) for i in range(5)]
+        await writer.flush()
+        assert all(future.result() for future in futures)
+        for i in range(5):
+            assert (tmp_path / 'a' / ('%d.yml' % i)).read_text() == 'content %d' % i
+        assert writer._known_dirs == {str(tmp_path / 'a')}
+
+    async def test_write_does_not_overwrite_existing_files(self, writer, tmp_path):
+        target = tmp_path / 'existing.yml'
+        target.write_text('original')
+        written = writer.write(str(target), 'new')
+        first = writer.write(str(tmp_path / 'new.yml'), 'first')
+        second = writer.write(str(tmp_path / 'new.yml'), 'second')
+        await writer.flush()
+        assert not written.result()
+        assert target.read_text() == 'original'
+        assert first.result() and not second.result()
+        assert (tmp_path / 'new.yml').read_text() == 'first'
+
+    async def test_writes_to_the_same_path_keep_queue_order_across_batches(self, tmp_path):
+        writer = IngestionWriter(logging.getLogger('test_ingestion_writer'), max_workers=4, batch_size=1)
+        write_file = writer._write_file
+
+        def _slow_first_write(path, content):
+            if content == 'first':
+                time.sleep(0.1)
+            return write_file(path, content)
+        writer._write_file = _slow_first_write
+        try:
+            first = writer.write(str(tmp_path / 'shared.yml'), 'first')
+            second = writer.write(str(tmp_path / 'shared.yml'), 'second')
+            assert len(writer._in_flight) == 2
+            await writer.flush()
+        finally:
+            writer.shutdown()
+        assert first.result() and not second.result()
+        assert (tmp_path / 'shared.yml').read_text() == 'first'
+
+    async def test_flush_waits_for_full_batches(self, writer, tmp_path):
+        batches = emu_metrics.ingestion_phase_seconds.get(phase='file_write')['count']
+        futures = [writer.write(str(tmp_path / ('%d.yml' % i)), 'content') for i in range(3)]
+        assert not writer._pending
+        await writer.flush()
+        assert all(future.done() for future in futures)
+        assert not writer._in_flight
+        assert emu_metrics.ingestion_phase_seconds.get(phase='file_write')['count'] == batches + 1
+
+    async def test_copy_errors_are_raised_to_awaiting_callers(self, writer, tmp_path):
+        with patch.object(shutil, 'copyfile', side_effect=IOError('disk full')):
+            copied = writer.copy('source.yml', str(tmp_path / 'target.yml'))
+            await writer.flush()
+        with pytest.raises(IOError):
+            await copied
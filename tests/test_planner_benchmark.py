@@ -0,0 +1,24 @@
+import pytest
+
+from plugins.emu.tests.benchmarks.planner_benchmark import run_benchmark
+
+
+class TestPlannerBenchmark:
+    @pytest.mark.parametrize('profile_links, planner_params', [
+        (False, dict()),
+        (True, dict()),
+        (False, dict(pipelined=True, scheduling='waves')),
+    ])
+    async def test_run_benchmark(self, profile_links, planner_params):
+        results = await run_benchmark(agents=12, groups=3, abilities=6, facts=2, profile_links=profile_links,
+                                      planner_params=planner_params)
+        assert results['links']['used'] > 0
+        assert results['links']['used'] <= results['links']['generated']
+        assert results['buckets']['fetch_and_run_links']['count'] >= 2
+        assert results['peak_memory_bytes'] > 0
+
+    async def test_ability_scoped_links_are_all_used(self):
+        scoped = await run_benchmark(agents=12, groups=3, abilities=6, facts=2)
+        profile = await run_benchmark(agents=12, groups=3, abilities=6, facts=2, profile_links=True)
+        assert scoped['links']['used'] == scoped['links']['generated'] == profile['links']['used']
+        assert profile['links']['generated'] > profile['links']['used']